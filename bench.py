@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+""" Benchmark riproducibile di mover.py.
+
+Genera un albero sintetico di backup ( <sorgente>/<server>/month/<file> ) con numero di server,
+file per cartella month, distribuzione delle dimensioni e date di modifica configurabili, poi misura
+le fasi di scansione, pianificazione e trasferimento verso una cartella su tmpfs o su un loopback
+che prende il posto del disco USB. Per ogni fase vengono riportati tempo, file/s, MB/s e picco di
+memoria (RSS) in formato JSON, così da poter confrontare le esecuzioni nel tempo.
+
+Ogni fase viene eseguita in un processo figlio ( fork ) così il picco di RSS è quello della sola fase.
+"""
+import argparse
+import configparser
+import contextlib
+import io
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+from datetime import datetime
+
+import mover
+
+
+# data di modifica del file più vecchio generato: fissa per rendere i nomi di destinazione riproducibili
+BASE_MTIME = datetime(2020, 1, 1).timestamp()
+
+
+def parse_size(value):
+    """ Converte dimensioni come '512K', '4M', '1G' in byte """
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    value = value.strip().upper()
+    if value[-1:] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def file_sizes(rnd, count, size, distribution):
+    """ Ritorna 'count' dimensioni secondo la distribuzione richiesta, con media 'size' """
+    if distribution == "fixed":
+        return [size] * count
+    if distribution == "uniform":
+        return [rnd.randint(1, 2 * size) for _ in range(count)]
+    # lognormal: pochi file molto grandi e molti piccoli, come le immagini disco reali
+    sigma = 1.0
+    mu = max(0.0, math.log(size) - sigma ** 2 / 2)
+    return [max(1, int(rnd.lognormvariate(mu, sigma))) for _ in range(count)]
+
+
+def generate_tree(source_dir, servers, files, size, distribution, compressible, seed):
+    """ Crea l' albero sintetico e ritorna (numero file, byte totali).
+        'compressible' è la frazione di ogni file riempita di zeri, il resto è casuale """
+    rnd = random.Random(seed)
+    sizes = file_sizes(rnd, servers * files, size, distribution)
+    total = 0
+    for srv in range(servers):
+        month = os.path.join(source_dir, "srv{:03d}".format(srv), "month")
+        os.makedirs(month)
+        for index in range(files):
+            file_size = sizes[srv * files + index]
+            random_part = int(file_size * (1 - compressible))
+            path = os.path.join(month, "img{:03d}.img".format(index))
+            with open(path, "wb") as file:
+                file.write(rnd.randbytes(random_part))
+                file.write(bytes(file_size - random_part))
+            # un file al giorno per server, con un piccolo sfasamento tra i server
+            mtime = BASE_MTIME + index * 86400 + srv * 60
+            os.utime(path, (mtime, mtime))
+            total += file_size
+    return servers * files, total
+
+
+def write_configuration(path, dest_dir, overrides):
+    """ Scrive il mover.cfg usato dal benchmark partendo da quello del repository """
+    configuration = configparser.ConfigParser()
+    configuration.read(os.path.join(os.path.dirname(os.path.abspath(__file__)), "mover.cfg"))
+    configuration["disk"]["mount_point"] = dest_dir
+    configuration["disk"]["threshold"] = "0"
+    configuration["disk"]["multi"] = "no"
+    for override in overrides:
+        key, value = override.split("=", 1)
+        section, option = key.split(".", 1)
+        if not configuration.has_section(section):
+            configuration.add_section(section)
+        configuration[section][option] = value
+    with open(path, "w") as file:
+        configuration.write(file)
+
+
+def stage_scan():
+    started = time.perf_counter()
+    index = mover.ScanIndex.from_configuration(mover.Configurator(mover.CONF_PATH))
+    scheduler = mover.TransferScheduler(mover.BackupMover.find_servers(mover.SOURCE_DIR, index), index)
+    files = sum(len(queue) for queue in scheduler.queues.values())
+    return {"seconds": time.perf_counter() - started, "files": files}
+
+
+def stage_plan():
+    output = io.StringIO()
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(output):
+        mover.plan_transfers(free_gb=1024 ** 2)
+    seconds = time.perf_counter() - started
+    # le righe degli archivi pianificati iniziano con il numero d' ordine
+    planned = [line for line in output.getvalue().splitlines() if line.strip()[:1].isdigit()]
+    return {"seconds": seconds, "files": len(planned)}
+
+
+def stage_transfer(workers):
+    started = time.perf_counter()
+    backup_mover = mover.BackupMover()
+    if backup_mover.configuration.is_enabled("transfer", "pipeline"):
+        moved = backup_mover.move_pipeline(workers)
+    else:
+        moved = backup_mover.move_all(mover.TransferScheduler(backup_mover.srv_path_all), workers)
+    seconds = time.perf_counter() - started
+    written = 0
+    for target in backup_mover.targets:
+        for root, _, names in os.walk(target.mount_point):
+            written += sum(os.path.getsize(os.path.join(root, name)) for name in names)
+    return {"seconds": seconds, "files": moved, "bytes_written": written}
+
+
+class StageError(Exception):
+    """ Fase non riuscita nel processo figlio """
+
+
+def run_stage(function, *args):
+    """ Esegue la fase in un processo figlio e aggiunge il picco di RSS ( kB ) della sola fase.
+        Se la fase non riesce solleva StageError con l' errore del figlio """
+    def child(connection):
+        try:
+            result = function(*args)
+            result["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            connection.send((None, result))
+        except BaseException:
+            connection.send((traceback.format_exc(), None))
+        finally:
+            connection.close()
+
+    context = multiprocessing.get_context("fork")
+    parent_end, child_end = context.Pipe(duplex=False)
+    process = context.Process(target=child, args=(child_end,))
+    process.start()
+    child_end.close()
+    try:
+        error, result = parent_end.recv()
+    except EOFError:
+        error, result = None, None
+    process.join()
+    if error is not None:
+        raise StageError(error.rstrip())
+    if result is None or process.exitcode:
+        raise StageError("il processo figlio è terminato con codice {}".format(process.exitcode))
+    return result
+
+
+def add_rates(result, total_bytes):
+    seconds = result["seconds"] or 1e-9
+    result["files_per_s"] = round(result["files"] / seconds, 2)
+    result["mb_per_s"] = round(total_bytes / 1024 / 1024 / seconds, 2)
+    result["seconds"] = round(result["seconds"], 4)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark riproducibile di mover.py su un albero sintetico")
+    parser.add_argument("--servers", type=int, default=10, help="numero di server ( default 10 )")
+    parser.add_argument("--files", type=int, default=10, help="file per cartella month ( default 10 )")
+    parser.add_argument("--size", type=parse_size, default=parse_size("4M"),
+                        help="dimensione media dei file, es. 512K, 4M, 1G ( default 4M )")
+    parser.add_argument("--distribution", choices=("fixed", "uniform", "lognormal"), default="fixed",
+                        help="distribuzione delle dimensioni ( default fixed )")
+    parser.add_argument("--compressible", type=float, default=0.5,
+                        help="frazione di ogni file riempita di zeri ( default 0.5 )")
+    parser.add_argument("--seed", type=int, default=1, help="seme del generatore casuale ( default 1 )")
+    parser.add_argument("--workers", type=int, default=1, help="copie in parallelo ( default 1 )")
+    parser.add_argument("--source", help="cartella in cui generare l' albero ( default temporanea in /tmp )")
+    parser.add_argument("--dest", help="cartella che sostituisce il disco USB, su tmpfs o loopback "
+                                       "( default temporanea in /dev/shm )")
+    parser.add_argument("--set", dest="overrides", action="append", default=[], metavar="SEZIONE.CHIAVE=VALORE",
+                        help="sovrascrive un valore di mover.cfg, es. compression.enabled=yes ( ripetibile )")
+    parser.add_argument("--stages", default="scan,plan,transfer",
+                        help="fasi da eseguire separate da virgola ( default scan,plan,transfer )")
+    parser.add_argument("--output", help="aggiunge il risultato come riga JSON a questo file")
+    parser.add_argument("--keep", action="store_true", help="non cancella le cartelle temporanee")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="mover-bench-")
+    source_dir = args.source or os.path.join(work_dir, "backup")
+    shm = "/dev/shm" if os.path.isdir("/dev/shm") else None
+    dest_dir = args.dest or tempfile.mkdtemp(prefix="mover-bench-dest-", dir=shm)
+    os.makedirs(dest_dir, exist_ok=True)
+    conf_path = os.path.join(work_dir, "mover.cfg")
+    try:
+        write_configuration(conf_path, dest_dir, args.overrides)
+        mover.CONF_PATH = conf_path
+        mover.SOURCE_DIR = source_dir
+        mover.LOG_DIR = os.path.join(work_dir, "log/")  # indice e catalogo di default
+
+        started = time.perf_counter()
+        files, total_bytes = generate_tree(
+            source_dir, args.servers, args.files, args.size, args.distribution, args.compressible, args.seed
+        )
+        stages = {"generate": add_rates({"seconds": time.perf_counter() - started, "files": files}, total_bytes)}
+        for stage in args.stages.split(","):
+            stage = stage.strip()
+            try:
+                if stage == "scan":
+                    # la prima scansione costruisce l' indice, la seconda lo riusa
+                    stages["scan"] = add_rates(run_stage(stage_scan), 0)
+                    stages["scan_warm"] = add_rates(run_stage(stage_scan), 0)
+                elif stage == "plan":
+                    stages["plan"] = add_rates(run_stage(stage_plan), 0)
+                elif stage == "transfer":
+                    stages["transfer"] = add_rates(run_stage(stage_transfer, args.workers), total_bytes)
+                else:
+                    parser.error("fase sconosciuta: {}".format(stage))
+            except StageError as error:
+                print("Fase '{}' non riuscita:\n{}".format(stage, error), file=sys.stderr)
+                return 1
+
+        result = {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "version": mover.__version__,
+            "python": platform.python_version(),
+            "params": {
+                "servers": args.servers,
+                "files": args.files,
+                "size": args.size,
+                "distribution": args.distribution,
+                "compressible": args.compressible,
+                "seed": args.seed,
+                "workers": args.workers,
+                "overrides": args.overrides,
+                "total_bytes": total_bytes,
+                # sullo stesso filesystem il trasferimento è un semplice rename e non misura la copia
+                "same_filesystem": os.stat(source_dir).st_dev == os.stat(dest_dir).st_dev,
+            },
+            "stages": stages,
+        }
+        line = json.dumps(result, sort_keys=True)
+        print(line)
+        if args.output:
+            with open(args.output, "a") as file:
+                file.write(line + "\n")
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            if not args.dest:
+                shutil.rmtree(dest_dir, ignore_errors=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,14 +2,35 @@
 import smtplib
 import shutil
 import os
+import errno
+import hashlib
+import json
+import fcntl
+import re
+import sqlite3
+import struct
 import glob
+import heapq
 import logging
 import logging.handlers
 import sys
+import time
+import argparse
+import asyncio
+import atexit
+import contextlib
+import ctypes
+import mmap
+import platform
+import queue
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from email.message import EmailMessage
-from datetime import datetime
+from datetime import datetime, timedelta
 from configparser import ConfigParser
-from subprocess import call, Popen, PIPE, STDOUT
+from subprocess import run, PIPE, STDOUT
 
 
 __author__ = "Andrea Magista'"
@@ -38,6 +59,7 @@ def send_mail(msg_from="Backup Storico",
     msg.set_content(content)
 
     if attach_name is not None:
+        flush_log()
         try:
             with open(attach_name) as attachment:
                 attachment_data = attachment.read()
@@ -59,8 +81,34 @@ def disk_usage_gb(fullpath):
     return total_in_gb, used_in_gb, free_in_gb
 
 
+def bytes_to_gb(size):
+    return float(round(size / 1024 / 1024 / 1024, 2))
+
+
+def default_db_path(name):
+    """ Path predefinito di un database SQLite: nella cartella dei log e non nella radice della cartella
+        sorgente, la cui data di modifica cambierebbe a ogni scrittura ( file -journal ) facendola rileggere
+        dall' indice a ogni esecuzione. Un database lasciato nella vecchia posizione viene spostato """
+    path = os.path.join(LOG_DIR, name)
+    legacy = os.path.join(SOURCE_DIR, name)
+    os.makedirs(LOG_DIR, exist_ok=True)
+    if os.path.isfile(legacy) and not os.path.exists(path):
+        os.replace(legacy, path)
+    return path
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """ QueueHandler che mette in coda il record così com' è: la formattazione del messaggio e dell' eventuale
+        traceback avviene nel thread del listener invece che in quello di chi scrive nel log.
+        Gli argomenti dei messaggi vengono quindi letti più tardi e non devono essere modificati dopo la chiamata """
+
+    def prepare(self, record):
+        return record
+
+
 def logger():
-    """ crea oggetto logger """
+    """ crea oggetto logger. I messaggi vengono messi in coda e scritti da un thread separato ( QueueListener )
+        su un unico file a rotazione e sulla console, così chi scrive nel log non attende mai l' I/O """
     configuration = Configurator(CONF_PATH)
     log_name = configuration.get("log", "name")
     log_path = os.path.join(LOG_DIR, "{}".format(log_name))
@@ -74,15 +122,10 @@ def logger():
         log.setLevel(logging.INFO)
         formatter = logging.Formatter("[%(levelname)s] %(asctime)s : %(message)s")
 
-    # file_handler
-    file_handler = logging.FileHandler(log_path)
-    file_handler.setFormatter(formatter)
-
-    # rotate_handler
+    # rotate_handler: il file viene aperto solo alla prima scrittura, così la rotazione conserva il log precedente
     log_count = int(configuration.get("log", "count"))
-    rotate_handler = logging.handlers.RotatingFileHandler(log_path, mode="w", backupCount=log_count)
+    rotate_handler = logging.handlers.RotatingFileHandler(log_path, mode="w", backupCount=log_count, delay=True)
     rotate_handler.setFormatter(formatter)
-    log.addHandler(rotate_handler)
 
     # Effettuo rotazione backup
     should_roll_over = os.path.isfile(log_path)
@@ -93,13 +136,37 @@ def logger():
     stream_handler = logging.StreamHandler()
     stream_handler.setFormatter(formatter)
 
-    # Aggiungo handlers
-    log.addHandler(stream_handler)
-    log.addHandler(file_handler)
+    # Aggiungo handlers: la formattazione e la scrittura avvengono nel thread del listener
+    log_queue = queue.Queue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.listener = logging.handlers.QueueListener(
+        log_queue, rotate_handler, stream_handler, respect_handler_level=True
+    )
+    log.addHandler(queue_handler)
+    queue_handler.listener.start()
+    atexit.register(queue_handler.listener.stop)
 
     return log
 
 
+def flush_log():
+    """ Attende che il thread del log abbia scritto tutti i messaggi in coda ( es. prima di allegare il log ) """
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, logging.handlers.QueueHandler):
+            handler.queue.join()
+
+
+def rotate_log():
+    """ Chiude il file di log corrente e ne inizia uno nuovo """
+    flush_log()
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, logging.handlers.QueueHandler):
+            for target in handler.listener.handlers:
+                if isinstance(target, logging.handlers.RotatingFileHandler):
+                    with target.lock:
+                        target.doRollover()
+
+
 class Configurator:
     def __init__(self, conf_file):
         self.conf_file = conf_file
@@ -121,6 +188,12 @@ class Configurator:
         """ Acquisisce un valore dal file di configurazione, il valore è sempre una stringa """
         return self.configuration[section][key]
 
+    def is_enabled(self, section, key):
+        """ Ritorna True se l' opzione è presente e vale yes/true/on/1 """
+        if not self.exists(section, key):
+            return False
+        return self.get(section, key).strip().lower() in ("yes", "true", "on", "1")
+
     def exists(self, section, key):
         """ Determina se il campo degli argomenti è valorizzato o no. True = valorizzato False = non valorizzato """
         try:
@@ -130,283 +203,2244 @@ class Configurator:
             return False
 
 
+class DeviceResolver:
+    """ Istantanea dei dischi presenti e dei mount letta direttamente da /dev/disk/by-uuid e
+        /proc/self/mountinfo, senza lanciare blkid o mount. L' istantanea viene riletta solo con refresh(),
+        da chiamare dopo ogni mount o umount """
+
+    BY_UUID = "/dev/disk/by-uuid"
+    MOUNTINFO = "/proc/self/mountinfo"
+
+    log = logging.getLogger('resolver')
+    null_handler = logging.NullHandler()
+    log.addHandler(null_handler)
+
+    def __init__(self):
+        self.devices = {}  # uuid -> device ( es. /dev/sdb1 )
+        self.mounts = []   # lista di (major:minor, sorgente, mount point)
+        self.refresh()
+
+    @staticmethod
+    def unescape(field):
+        """ mountinfo codifica spazi e caratteri speciali in ottale ( es. \\040 ) """
+        return re.sub(r"\\([0-7]{3})", lambda match: chr(int(match.group(1), 8)), field)
+
+    def refresh(self):
+        self.devices = {}
+        try:
+            with os.scandir(self.BY_UUID) as iterator:
+                for entry in iterator:
+                    self.devices[entry.name] = os.path.realpath(entry.path)
+        except FileNotFoundError:
+            pass
+        self.mounts = []
+        with open(self.MOUNTINFO) as mountinfo:
+            for line in mountinfo:
+                fields = line.split()
+                # dopo il separatore "-" ci sono tipo di filesystem, sorgente e opzioni del superblocco
+                source = fields[fields.index("-", 6) + 2] if "-" in fields[6:] else ""
+                self.mounts.append((fields[2], self.unescape(source), self.unescape(fields[4]).rstrip("/") or "/"))
+        self.log.debug("Letti %s dischi e %s mount", len(self.devices), len(self.mounts))
+
+    @classmethod
+    def attached_uuids(cls):
+        """ Ritorna gli UUID dei dischi collegati con una sola lettura di /dev/disk/by-uuid """
+        try:
+            return set(os.listdir(cls.BY_UUID))
+        except FileNotFoundError:
+            return set()
+
+    def device(self, uuid):
+        """ Ritorna il device del disco con l' UUID indicato oppure None se non è collegato """
+        return self.devices.get(uuid)
+
+    @staticmethod
+    def device_number(device):
+        number = os.stat(device).st_rdev
+        return "{}:{}".format(os.major(number), os.minor(number))
+
+    def mount_points(self, device):
+        """ Ritorna i punti in cui è montato il device. Il confronto principale è con la sorgente del mount,
+            perché su btrfs o FUSE il major:minor di mountinfo è anonimo e non coincide con quello del device """
+        device = os.path.realpath(device)
+        number = self.device_number(device)
+        return [mount_point for dev, source, mount_point in self.mounts
+                if (source.startswith("/") and os.path.realpath(source) == device) or dev == number]
+
+    def is_mount_point(self, path):
+        """ Ritorna True se qualcosa è montato esattamente in path """
+        path = path.rstrip("/") or "/"
+        return any(mount_point == path for _, _, mount_point in self.mounts)
+
+
 class MountUsb:
 
     log = logging.getLogger('mount')
     null_handler = logging.NullHandler()
     log.addHandler(null_handler)
 
-    def __init__(self):
+    def __init__(self, uuids=None, mount_point=None, resolver=None):
 
         # carico file di configurazione
         self.configuration = Configurator(os.path.join(BASE_DIR, "backup/mover.cfg"))
 
-        self.log.info("=======  COPIA BACKUP STORICO SU DISCO ESTERNO  =======  \n")
+        # dischi gestiti da questa istanza ( di default tutti quelli del file di configurazione )
+        self.uuids = uuids or self.configuration.get_as_list("disk", "uuid")
+        self.uuid = None
 
         # definisco il punto di mount
-        self.mount_point = self.configuration.get_path()
+        self.mount_point = (mount_point or self.configuration.get_path()).rstrip("/")
+
+        # istantanea di dischi e mount, riletta solo dopo un mount o un umount
+        self.resolver = resolver or DeviceResolver()
 
         # controllo eventuali mount appesi
         self.check_hanging_mount()
 
+    def run(self, *command):
+        """ Esegue il comando una sola volta catturandone l' output. Ritorna il codice di uscita.
+            In caso di errore l' output viene stampato nel log in modalità debug """
+        self.log.debug("Eseguo '%s'", " ".join(command))
+        result = run(command, stdout=PIPE, stderr=STDOUT, universal_newlines=True)
+        if result.returncode != 0:
+            self.log.debug("Output del comando '%s':\n%s", " ".join(command), result.stdout)
+        return result.returncode
+
+    def umount(self, mount_point):
+        """ Smonta (lazy) il punto indicato e aggiorna l' istantanea dei mount """
+        u_mount = self.run("/bin/umount", "-l", mount_point)
+        self.resolver.refresh()
+        return u_mount
+
     def check_hanging_mount(self):
         """ Effettua la verifica di avevntuali mount appesi e nel caso li elimina.
             Se in modalità debug in caso di errore stamperà l' output di errore nel file.log """
         self.log.debug("In esecuzione la funzione 'check_hanging_mount'")
-        command = Popen("/bin/mount", shell=True, stdout=PIPE)
-        self.log.debug(
-            "Eseguo il parsing dell' output del comando '/bin/mount'"
+        if not self.resolver.is_mount_point(self.mount_point):
+            return
+        self.log.warning(
+            "Trovato mount precedente appeso in '%s'. Provvedo a rimuoverlo", self.mount_point
         )
-        for line in command.stdout:
-            line_cod = line.decode("utf-8")
-            if self.mount_point in line_cod:
-                self.log.debug(line_cod)
-                self.log.warning(
-                    "Trovato mount precedente appeso in '{}'. Provvedo a rimuoverlo"
-                        .format(self.mount_point)
-                )
-                self.log.debug(
-                    "Eseguo call '/bin/mount -l {}'"
-                        .format(self.mount_point)
+        if self.umount(self.mount_point) != 0:
+            self.log.error("Non è stato possibile rimuovere il mount appeso")
+        else:
+            self.log.info("Rimozione mount appeso avvenuto con successo. Effettuo di nuovo la verifica")
+            if self.resolver.is_mount_point(self.mount_point):
+                self.log.error(
+                    "Trovato nuovamente mount precedente appeso in '%s'. Esecuzione interrotta", self.mount_point
                 )
-                u_mount = call("/bin/umount -l {}".format(self.mount_point), shell=True)
-                if u_mount != 0:
-                    self.log.error("Non è stato possibile rimuovere il mount appeso")
-                    if self.configuration.get("log", "level") == "debug":
-                        self.log.debug("Stampo output del comando '/bin/mount -l {}' \n"
-                                       .format(self.mount_point)
-                                       )
-                        u_mount = Popen(
-                            "/bin/umount -l {}"
-                            .format(self.mount_point),
-                            shell=True,
-                            stdout=PIPE,
-                            stderr=STDOUT
-                        )
-                        for output in u_mount.stdout and u_mount.stderr:
-                            output_cod = output.decode("utf-8")
-                            self.log.debug("{}".format(output_cod))
-                else:
-                    self.log.info("Rimozione mount appeso avvenuto con successo. Effettuo di nuovo la verifica")
-                    command = Popen("/bin/mount", shell=True, stdout=PIPE)
-                    self.log.debug("Eseguo Popen su '/bin/mount'")
-                    for line in command.stdout:
-                        line_cod = line.decode("utf-8")
-                        if self.mount_point in line_cod:
-                            self.log.error(
-                                "Trovato nuovamente mount precedente appeso in '{}'. Esecuzione interrotta"
-                                    .format(self.mount_point)
-                            )
-                            sys.exit()
-                        else:
-                            self.log.info("Nessun mount appeso trovato")
-                            return
+                sys.exit()
+            self.log.info("Nessun mount appeso trovato")
 
     def disk_is_present(self):
         """ controlla se uno dei dischi è presente sulla basse degli uuid inseriti nel file .conf"""
         self.log.debug("In esecuzione la funzione 'disk_is_present'")
-        is_present = None
-        self.log.debug("Eseguo Popen di '/sbin/blkid'")
-        command = Popen("/sbin/blkid", stdout=PIPE, shell=True)
-        for line in command.stdout:
-            line_cod = line.decode("utf-8")
-            for uuid in self.configuration.get_as_list("disk", "uuid"):
-                if uuid in line_cod:
-                    self.log.info("Rilevato disco con UUID '{}'".format(uuid))
-                    self.uuid = uuid
-                    self.log.debug("Valore variabile 'self.uuid': {}".format(self.uuid))
-                    is_present = True
-                    self.log.debug("disk_is_present = {} \n".format(is_present))
-                    return is_present
-                else:
-                    is_present = False
-                    continue
-        self.log.debug("disk_is_present = {} \n".format(is_present))
-        return is_present
+        for uuid in self.uuids:
+            if self.resolver.device(uuid) is not None:
+                self.log.info("Rilevato disco con UUID '%s'", uuid)
+                self.uuid = uuid
+                self.log.debug("disk_is_present = True \n")
+                return True
+        self.log.debug("disk_is_present = False \n")
+        return False
 
     def is_mounted(self, uuid):
-        """ Controlla se il disco è montato:
+        """ Controlla se il disco è montato nel punto di mount, se non lo è prova a montarlo:
             True = montato
             False = non montato
             """
         self.log.debug("In esecuzione la funzione 'is_mounted'")
-        is_mount = os.path.ismount(self.mount_point)
+        device = self.resolver.device(uuid)
+        is_mount = self.mount_point in self.resolver.mount_points(device)
         if not is_mount:
-            self.log.info("il disco non è montato. Provvedo a montarlo in '{}'".format(self.mount_point))
-            mount = call("/bin/mount -U {} {}".format(uuid, self.mount_point), shell=True)
+            self.log.info("il disco non è montato. Provvedo a montarlo in '%s'", self.mount_point)
+            mount = self.run("/bin/mount", "-U", uuid, self.mount_point)
+            self.resolver.refresh()
             if mount != 0:
                 self.log.error("Non è stato possibile montare il disco")
-                if self.configuration.get("log", "level") == "debug":
-                    self.log.debug("Stampo output del comando '/bin/mount -U {} {} \n".format(uuid, self.mount_point))
-                    command = Popen(
-                        "/bin/mount -U {} {}"
-                        .format(uuid, self.mount_point),
-                        shell=True,
-                        stdout=PIPE,
-                        stderr=STDOUT
-                    )
-                    for line in command.stdout:
-                        line_cod = line.decode("utf-8")
-                        self.log.debug("{}".format(line_cod))
             else:
-                is_mount = os.path.ismount(self.mount_point)
-        self.log.debug("Valore funzione 'is_mounted': {} \n".format(is_mount))
+                is_mount = self.mount_point in self.resolver.mount_points(device)
+        self.log.debug("Valore funzione 'is_mounted': %s \n", is_mount)
         return is_mount
 
     def handle_wrong_mount_point(self):
         """ nel caso in cui il disco sia montato nel punto sbagliato lo smonta e lo monta nel punto corretto """
         self.log.debug("Funzione 'handle_wrong_mount_point' in esecuzione")
-        self.log.info("Il disco presente è {}".format(self.uuid))
-        right_spot = None
-        command = Popen("/sbin/blkid", shell=True, stdout=PIPE)
-        for line in command.stdout:
-            line_cod = line.decode("utf-8")
-            if self.uuid in line_cod:
-                disk_id = line_cod.split()[0].strip(":")
-                self.log.debug("Identifico il nome della partizione")
-                self.log.debug("Il disco è {}".format(disk_id))
-                command_2 = Popen(
-                    "/bin/mount", shell=True, stdout=PIPE
-                )
-                for line in command_2.stdout:
-                    line_cod = line.decode("utf-8")
-                    if disk_id in line_cod:
-                        base = line_cod.split()
-                        index = base.index("on")
-                        new_index = index + 1
-                        wrong_mount_point = base[new_index]
-                        self.log.debug("Valore della variabile 'wrong_mount_point' : {}".format(wrong_mount_point))
-                        if wrong_mount_point != self.mount_point:
-                            self.log.warning(
-                                "il mount point corretto è '{}' ma il disco '{}' è montato in '{}'"
-                                .format(self.mount_point, self.uuid,wrong_mount_point)
-                                        )
-                            right_spot = True
-                            self.log.info("Smonto il disco da {}".format(wrong_mount_point))
-                            umount = call("/bin/umount -l {}".format(wrong_mount_point), shell=True)
-                            if umount != 0:
-                                self.log.error("Non è stato possibile smontare il disco. Esecuzione interretta")
-                                if self.configuration.get("log", "level") == "debug":
-                                    umount = Popen("/bin/umount -l {}"
-                                                   .format(wrong_mount_point),
-                                                   shell=True,
-                                                   stdout=PIPE,
-                                                   stderr=STDOUT
-                                                   )
-                                    for output in umount.stdout:
-                                        output_cod = output.decode("utf-8")
-                                        self.log.debug(
-                                            "Stampo output del comando '/bin/umount -l {} \n".format(wrong_mount_point)
-                                        )
-                                        self.log.debug("{}".format(output_cod))
-                                else:
-                                    self.log.debug("Chiudo Script")
-                                    return
-                            else:
-                                check = self.is_mounted(self.uuid)
-                                self.log.debug("Fine esecuzione 'handle_wrong_mount_point'")
-                                if check:
-                                    self.log.info(
-                                        "il disco con UUID '{}' è montato correttamente in '{}'"
-                                        .format(self.uuid, self.mount_point)
-                                    )
-                                    right_spot = True
-                        else:
-                            self.log.error("Il disco è montato nel punto corretto. Errore sconosciuto")
-                            return sys.exit()
-                    else:
-                        continue
-        self.log.debug("Valore di 'handle_wrong_mount_point' : {}".format(right_spot))
+        self.log.info("Il disco presente è %s", self.uuid)
+        device = self.resolver.device(self.uuid)
+        self.log.debug("Il disco è %s", device)
+        wrong_mount_points = [path for path in self.resolver.mount_points(device) if path != self.mount_point]
+        if not wrong_mount_points:
+            self.log.error("Il disco non è montato in un punto diverso da quello corretto. Errore sconosciuto")
+            return False
+        for wrong_mount_point in wrong_mount_points:
+            self.log.warning(
+                "il mount point corretto è '%s' ma il disco '%s' è montato in '%s'",
+                self.mount_point, self.uuid, wrong_mount_point
+            )
+            self.log.info("Smonto il disco da %s", wrong_mount_point)
+            if self.umount(wrong_mount_point) != 0:
+                self.log.error("Non è stato possibile smontare il disco. Esecuzione interretta")
+                return False
+        right_spot = self.is_mounted(self.uuid)
+        if right_spot:
+            self.log.info(
+                "il disco con UUID '%s' è montato correttamente in '%s'", self.uuid, self.mount_point
+            )
+        self.log.debug("Valore di 'handle_wrong_mount_point' : %s", right_spot)
         return right_spot
 
     def can_exec_backup(self):
         """ Verifica se il disco è presente e montato. Se ritorna True il backup si può eseguire """
         self.log.debug("Funzione 'can_exec_backup' in esecuzione")
-        if self.disk_is_present() and self.is_mounted(self.uuid):
+        if not self.disk_is_present():
+            self.log.warning("Non è stato rilevato alcun disco")
+            start = False
+        elif self.is_mounted(self.uuid):
             start = True
             self.log.info(
-                "il disco con UUID '{}' è montato correttamente in '{}'\n"
-                .format(self.uuid, self.mount_point)
+                "il disco con UUID '%s' è montato correttamente in '%s'\n", self.uuid, self.mount_point
             )
-        elif not self.disk_is_present():
-            self.log.warning("Non è stato rilevato alcun disco")
-            start = False
         else:
             self.log.warning("Non è stato possibile montare il disco a causa di un errore. Provo a risolvere\n")
-            if self.handle_wrong_mount_point():
-                start = True
-            else:
-                start = False
-        self.log.debug("Valore exec_backup = {}".format(start))
+            start = self.handle_wrong_mount_point()
+        self.log.debug("Valore exec_backup = %s", start)
         return start
 
     def unmount(self):
         self.log.debug("Funzione 'unmount' in esecuzione")
-        self.log.info("Smonto il disco da {}\n".format(self.mount_point))
-        umount = call("/bin/umount -l {}".format(self.mount_point), shell=True)
-        if umount == 0:
+        self.log.info("Smonto il disco da %s\n", self.mount_point)
+        if self.umount(self.mount_point) == 0:
             self.log.info("Disco smontato correttamente")
             return
         else:
             self.log.warning("Attenzione! il disco non è stato smontato")
 
 
-class BackupMover:
+def mount_targets(configuration):
+    """ Monta i dischi di destinazione e ritorna la lista dei MountUsb montati correttamente.
+        Con [disk] multi = yes ogni disco presente viene montato in '<mount_point>/<uuid>',
+        altrimenti viene montato in mount_point il primo disco trovato """
+    if not configuration.is_enabled("disk", "multi"):
+        mounter = MountUsb()
+        return [mounter] if mounter.can_exec_backup() else []
+    resolver = DeviceResolver()
+    mounters = []
+    for uuid in configuration.get_as_list("disk", "uuid"):
+        if resolver.device(uuid) is None:
+            MountUsb.log.info("Il disco con UUID '%s' non è collegato", uuid)
+            continue
+        mount_point = os.path.join(configuration.get_path(), uuid)
+        os.makedirs(mount_point, exist_ok=True)
+        mounter = MountUsb([uuid], mount_point, resolver)
+        if mounter.can_exec_backup():
+            mounters.append(mounter)
+    return mounters
 
-    log = logging.getLogger('mover')
+
+class GzipCompressor:
+    """ Compressione gzip parallela sul modello di pigz: il flusso viene diviso in blocchi compressi
+        in parallelo su un pool di thread (zlib rilascia il GIL) e scritti in ordine. Ogni blocco è un
+        membro gzip completo, quindi il file risultante è un normale stream gzip concatenato """
+
+    log = logging.getLogger('compression')
     null_handler = logging.NullHandler()
     log.addHandler(null_handler)
 
-    def __init__(self):
-        self.configuration = Configurator(CONF_PATH)
-        self.srv_path_all = [root for root, dirs, _, in os.walk(SOURCE_DIR) if "month" in dirs]
-        _, self.used_space, self.free_space = disk_usage_gb(self.configuration.get("disk", "mount_point"))
+    # firme dei formati già compressi che non vale la pena comprimere di nuovo
+    COMPRESSED_MAGIC = (
+        b"\x1f\x8b",                  # gzip
+        b"BZh",                       # bzip2
+        b"\xfd7zXZ\x00",              # xz
+        b"\x28\xb5\x2f\xfd",          # zstd
+        b"\x04\x22\x4d\x18",          # lz4
+        b"PK\x03\x04",               # zip
+        b"7z\xbc\xaf\x27\x1c",        # 7z
+    )
 
-    def check_threshold(self):
-        """ Controlla lo spazio disponibile in base alla soglia critica """
-        threshold = int(self.configuration.get("disk", "threshold"))
-        if self.free_space < threshold:
-            self.log.warning("Lo spazio disponibile è al di sotto della soglia critica")
-            self.log.warning("Soglia impostata a '{} GB'".format(threshold))
+    def __init__(self, level=6, threads=None, block_size=4 * 1024 * 1024):
+        self.level = level
+        self.threads = threads or os.cpu_count() or 1
+        self.block_size = block_size
+        # blocchi in volo per ogni flusso: limita la memoria tenendo occupati tutti i thread
+        self.max_pending = self.threads * 2
+        self.pool = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="gzip")
+
+    @classmethod
+    def from_configuration(cls, configuration):
+        """ Crea il compressore dalla sezione [compression] oppure ritorna None se disabilitato """
+        if not configuration.is_enabled("compression", "enabled"):
+            return None
+        level = 6
+        threads = None
+        block_mb = 4
+        if configuration.exists("compression", "level"):
+            level = int(configuration.get("compression", "level"))
+        if configuration.exists("compression", "threads"):
+            threads = int(configuration.get("compression", "threads")) or None
+        if configuration.exists("compression", "block_size"):
+            block_mb = int(configuration.get("compression", "block_size"))
+        return cls(level, threads, block_mb * 1024 * 1024)
+
+    def should_compress(self, path):
+        """ Ritorna False se il file è già compresso """
+        with open(path, "rb") as file:
+            head = file.read(8)
+        if head.startswith(self.COMPRESSED_MAGIC):
+            self.log.debug("'%s' è già compresso, lo copio senza comprimerlo", path)
             return False
         return True
 
-    def check_month_folder(self):
-        """ Esclude i server che non hanno file dentro la cartella month """
-        empty_path = []
-        for srv in self.srv_path_all:
-            path = os.path.join(srv, "month/*")
-            file_list = glob.glob(path)
-            if not file_list:
-                empty_path.append(srv)
-        result = [path for path in self.srv_path_all if path not in empty_path]
-        return result
+    def compress_block(self, block):
+        """ Comprime un blocco come membro gzip indipendente """
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        return compressor.compress(block) + compressor.flush()
+
+    def compress_stream(self, src, write):
+        """ Legge src a blocchi, li comprime in parallelo e chiama write(dati compressi, byte letti) nell' ordine
+            originale. Ritorna la tupla (byte letti, byte scritti) """
+        pending = deque()
+        read_total = 0
+        written = 0
+        for block in iter(lambda: src.read(self.block_size), b""):
+            read_total += len(block)
+            pending.append((self.pool.submit(self.compress_block, block), len(block)))
+            if len(pending) >= self.max_pending:
+                future, consumed = pending.popleft()
+                data = future.result()
+                write(data, consumed)
+                written += len(data)
+        if not read_total:  # anche un file vuoto deve diventare un gzip valido
+            pending.append((self.pool.submit(self.compress_block, b""), 0))
+        while pending:
+            future, consumed = pending.popleft()
+            data = future.result()
+            write(data, consumed)
+            written += len(data)
+        return read_total, written
+
+
+class TransferJournal:
+    """ Giornale delle copie in corso. Ogni copia viene scritta in '<destinazione>.part' e accanto viene salvato
+        '<destinazione>.journal' con sorgente, offset scritti in modo durevole e hash dei dati fino a quell' offset.
+        Se l' esecuzione viene interrotta la copia riparte dall' ultimo checkpoint invece che da zero """
+
+    log = logging.getLogger('journal')
+    null_handler = logging.NullHandler()
+    log.addHandler(null_handler)
+
+    PART_SUFFIX = ".part"
+    SUFFIX = ".journal"
+
+    def __init__(self, interval=256 * 1024 * 1024):
+        self.interval = interval  # byte scritti tra un checkpoint e l' altro
+
+    @classmethod
+    def from_configuration(cls, configuration):
+        """ Crea il giornale dalla sezione [journal] oppure ritorna None se disabilitato """
+        if configuration.exists("journal", "enabled") and not configuration.is_enabled("journal", "enabled"):
+            return None
+        checkpoint_mb = 256
+        if configuration.exists("journal", "checkpoint"):
+            checkpoint_mb = int(configuration.get("journal", "checkpoint"))
+        return cls(checkpoint_mb * 1024 * 1024)
+
+    @classmethod
+    def part_path(cls, dest):
+        return dest + cls.PART_SUFFIX
+
+    @classmethod
+    def path(cls, dest):
+        return dest + cls.SUFFIX
+
+    def load(self, dest):
+        """ Ritorna la voce del giornale per la destinazione oppure None """
+        try:
+            with open(self.path(dest)) as file:
+                return json.load(file)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save(self, entry):
+        """ Salva la voce in modo atomico ( file temporaneo + rename ) """
+        journal = self.path(entry["dest"])
+        tmp_path = journal + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(entry, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, journal)
+
+    def remove(self, dest):
+        try:
+            os.unlink(self.path(dest))
+        except FileNotFoundError:
+            pass
+
+    def discard(self, dest):
+        """ Elimina la copia parziale e la sua voce del giornale """
+        for path in (self.part_path(dest), self.path(dest)):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
 
     @staticmethod
-    def get_file_list(path):
-        """ Ritona la lista dei file dentro la cartella month """
-        f_path = os.path.join(path, "month/*")
-        f_list = glob.glob(f_path)
-        return f_list
+    def source_matches(entry):
+        """ Controlla che la sorgente registrata esista ancora e non sia cambiata """
+        try:
+            metadata = os.stat(entry["source"])
+        except OSError:
+            return False
+        return (metadata.st_size, metadata.st_mtime_ns, metadata.st_ino) == \
+            (entry["size"], entry["mtime_ns"], entry["inode"])
+
+    def cleanup(self, mount_point):
+        """ Rimuove le copie parziali che non possono più essere riprese: sorgente sparita o modificata
+            oppure file '.part' senza giornale """
+        for journal in glob.glob(os.path.join(mount_point, "*", "*" + self.SUFFIX)):
+            dest = journal[:-len(self.SUFFIX)]
+            entry = self.load(dest)
+            if entry is None or not self.source_matches(entry):
+                self.log.info("Elimino la copia parziale non più riprendibile di '%s'", os.path.basename(dest))
+                self.discard(dest)
+        for part in glob.glob(os.path.join(mount_point, "*", "*" + self.PART_SUFFIX)):
+            dest = part[:-len(self.PART_SUFFIX)]
+            if not os.path.exists(self.path(dest)):
+                self.log.info("Elimino la copia parziale senza giornale '%s'", os.path.basename(part))
+                os.unlink(part)
+
+
+class TransferProgress:
+    """ Stato di una singola copia: offset letti e scritti, hash progressivo dei dati scritti
+        e checkpoint periodici nel giornale """
+
+    log = logging.getLogger('transfer')
+
+    def __init__(self, engine, source, dest, metadata, compress):
+        self.engine = engine
+        self.journal = engine.journal
+        self.dest = dest
+        self.part = TransferJournal.part_path(dest)
+        self.digest = hashlib.new(engine.algorithm) if engine.algorithm else None
+        self.entry = {
+            "source": source,
+            "dest": dest,
+            "size": metadata.st_size,
+            "mtime_ns": metadata.st_mtime_ns,
+            "inode": metadata.st_ino,
+            "compress": compress,
+            "algorithm": engine.algorithm,
+        }
+        self.src_offset = 0
+        self.dst_offset = 0
+        self.last_checkpoint = 0
+        self.checkpointed = False
+        self.dst = None
+        self.src_fd = None
+        self.last_drop = 0
+
+    def open(self):
+        """ Apre il file parziale. Se il giornale contiene una copia interrotta della stessa sorgente
+            riparte dall' ultimo checkpoint, altrimenti ricomincia da zero """
+        previous = self.journal.load(self.dest) if self.journal is not None else None
+        if previous is not None and os.path.exists(self.part) and self.can_resume(previous):
+            self.dst = open(self.part, "r+b", buffering=0)
+            offset = previous["dst_offset"]
+            if os.fstat(self.dst.fileno()).st_size >= offset and self.rehash(offset, previous["checksum"]):
+                self.dst.truncate(offset)
+                self.dst.seek(offset)
+                self.src_offset = previous["src_offset"]
+                self.dst_offset = self.last_checkpoint = offset
+                self.checkpointed = True
+                self.log.info(
+                    "Riprendo la copia di '%s' da %s MB",
+                    os.path.basename(self.entry["source"]), round(self.src_offset / 1024 / 1024, 2)
+                )
+                return self.dst
+            self.dst.close()
+            self.log.warning("Copia parziale di '%s' non valida, ricomincio da capo", self.entry["source"])
+        self.dst = open(self.part, "wb", buffering=0)
+        return self.dst
+
+    def can_resume(self, previous):
+        return all(previous.get(key) == value for key, value in self.entry.items())
+
+    def rehash(self, offset, checksum):
+        """ Ricalcola l' hash dei dati già scritti: verifica il file parziale e ripristina lo stato dell' hash """
+        if self.digest is None:
+            return True
+        remaining = offset
+        while remaining:
+            data = self.dst.read(min(self.engine.buffer_size, remaining))
+            if not data:
+                break
+            self.digest.update(data)
+            remaining -= len(data)
+        if remaining or self.digest.hexdigest() != checksum:
+            self.digest = hashlib.new(self.engine.algorithm)
+            return False
+        return True
+
+    def write(self, data, consumed=None):
+        """ Scrive i dati nel file parziale. consumed indica i byte di sorgente che hanno prodotto i dati
+            (diverso dalla lunghezza quando i dati sono compressi) """
+        if self.digest is not None:
+            self.digest.update(data)
+        self.engine.write_all(self.dst, data)
+        self.advance(len(data), consumed)
+
+    def skip(self, data):
+        """ Registra un blocco già presente nel file parziale ( clonato dall' archivio precedente ) senza scriverlo """
+        if self.digest is not None:
+            self.digest.update(data)
+        self.dst.seek(len(data), os.SEEK_CUR)
+        self.advance(len(data))
+
+    def advance(self, written, consumed=None):
+        """ Aggiorna gli offset dopo una scrittura ed effettua il checkpoint quando necessario """
+        self.dst_offset += written
+        self.src_offset += written if consumed is None else consumed
+        if self.journal is not None and self.dst_offset - self.last_checkpoint >= self.journal.interval:
+            self.checkpoint()
+        if self.engine.throttle is not None:
+            self.engine.throttle.consume(written if consumed is None else consumed)
+        if self.engine.drop_cache and self.dst_offset - self.last_drop >= self.engine.DROP_WINDOW:
+            self.drop_cache()
+
+    def drop_cache(self):
+        """ Toglie dalla cache le pagine già copiate. Sulla destinazione le pagine ancora da scrivere vengono
+            solo avviate alla scrittura e sono liberate alla chiamata successiva, quando sono già su disco """
+        if self.src_fd is not None:
+            os.posix_fadvise(self.src_fd, 0, self.src_offset, os.POSIX_FADV_DONTNEED)
+        os.posix_fadvise(self.dst.fileno(), 0, self.dst_offset, os.POSIX_FADV_DONTNEED)
+        self.last_drop = self.dst_offset
+
+    def checkpoint(self):
+        """ Rende durevoli i dati scritti e registra l' offset nel giornale """
+        os.fsync(self.dst.fileno())
+        self.entry.update(
+            src_offset=self.src_offset,
+            dst_offset=self.dst_offset,
+            checksum=self.checksum(),
+        )
+        self.journal.save(self.entry)
+        self.last_checkpoint = self.dst_offset
+        self.checkpointed = True
+
+    def checksum(self):
+        return self.digest.hexdigest() if self.digest is not None else None
+
+
+class BlockSignature:
+    """ Firma a blocchi di un archivio sul modello di rsync: per ogni blocco di dimensione fissa un checksum
+        debole ( adler32 ) per la ricerca veloce e uno forte ( blake2b a 128 bit ) per la conferma.
+        Viene salvata accanto all' archivio in '<nome>.sig' così il mese successivo non serve rileggerlo """
+
+    log = logging.getLogger('delta')
+    null_handler = logging.NullHandler()
+    log.addHandler(null_handler)
+
+    SUFFIX = ".sig"
+    MAGIC = b"MVSIG1\n"
+    HEADER = struct.Struct(">I")
+    ENTRY = struct.Struct(">I16s")
+
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self.blocks = []  # (checksum debole, checksum forte) nell' ordine del file
+        self.table = {}   # checksum debole -> indici dei blocchi
+
+    @classmethod
+    def path(cls, archive):
+        return archive + cls.SUFFIX
 
     @staticmethod
-    def get_oldest_file(f_list):
-        """ Ritorna il file più vecchio in una lista di file """
-        oldest_file = min(f_list, key=os.path.getmtime)
-        return oldest_file
+    def strong(block):
+        return hashlib.blake2b(block, digest_size=16).digest()
+
+    def add(self, block):
+        """ Aggiunge il blocco successivo del file """
+        self.append(zlib.adler32(block), self.strong(block))
+
+    def append(self, weak, strong):
+        self.table.setdefault(weak, []).append(len(self.blocks))
+        self.blocks.append((weak, strong))
+
+    def find(self, block):
+        """ Ritorna l' indice di un blocco identico a 'block' oppure None. Il checksum forte viene
+            calcolato solo se quello debole corrisponde """
+        candidates = self.table.get(zlib.adler32(block))
+        if not candidates:
+            return None
+        strong = self.strong(block)
+        for index in candidates:
+            if self.blocks[index][1] == strong:
+                return index
+        return None
+
+    def save(self, archive):
+        """ Scrive la firma accanto all' archivio in modo atomico """
+        path = self.path(archive)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(self.MAGIC + self.HEADER.pack(self.block_size))
+            file.write(b"".join(self.ENTRY.pack(weak, strong) for weak, strong in self.blocks))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, archive, block_size):
+        """ Legge la firma salvata accanto all' archivio. Ritorna None se manca, non è valida
+            o è stata calcolata con una dimensione dei blocchi diversa """
+        try:
+            with open(cls.path(archive), "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            return None
+        header = len(cls.MAGIC) + cls.HEADER.size
+        if not data.startswith(cls.MAGIC) or len(data) < header or (len(data) - header) % cls.ENTRY.size:
+            return None
+        if cls.HEADER.unpack_from(data, len(cls.MAGIC))[0] != block_size:
+            return None
+        signature = cls(block_size)
+        for weak, strong in cls.ENTRY.iter_unpack(data[header:]):
+            signature.append(weak, strong)
+        return signature
+
+    @classmethod
+    def build(cls, path, block_size):
+        """ Calcola la firma leggendo il file """
+        signature = cls(block_size)
+        with open(path, "rb", buffering=0) as file:
+            for block in iter(lambda: file.read(block_size), b""):
+                signature.add(block)
+        return signature
+
+    @classmethod
+    def for_archive(cls, archive, block_size):
+        """ Ritorna la firma dell' archivio precedente: quella salvata se valida, altrimenti la calcola e
+            la salva per le prossime esecuzioni. Ritorna None per gli archivi compressi, che non hanno
+            blocchi in comune con un' immagine non compressa """
+        signature = cls.load(archive, block_size)
+        if signature is not None:
+            return signature
+        with open(archive, "rb") as file:
+            if file.read(8).startswith(GzipCompressor.COMPRESSED_MAGIC):
+                return None
+        cls.log.info("Calcolo la firma a blocchi di '%s'", os.path.basename(archive))
+        signature = cls.build(archive, block_size)
+        try:
+            signature.save(archive)
+        except OSError as error:
+            cls.log.debug("Impossibile salvare la firma di '%s': %s", archive, error)
+        return signature
+
+
+class Throttle:
+    """ Limite di banda e priorità di I/O delle copie secondo le fasce orarie di [throttle] schedule.
+        Il limite è un token bucket condiviso da tutte le copie in parallelo, la priorità viene impostata
+        con ioprio_set su ogni thread di copia. Fuori dalle fasce la copia va alla massima velocità
+        con la priorità predefinita """
+
+    log = logging.getLogger('throttle')
+    null_handler = logging.NullHandler()
+    log.addHandler(null_handler)
+
+    IOPRIO_WHO_PROCESS = 1
+    IOPRIO_CLASS_SHIFT = 13
+    IOPRIO_CLASSES = {"none": 0, "realtime": 1, "best-effort": 2, "idle": 3}
+    # numero della syscall ioprio_set per architettura, sulle altre viene usato ionice
+    SYS_IOPRIO_SET = {"x86_64": 251, "aarch64": 30, "i386": 289, "i686": 289, "armv7l": 314, "ppc64le": 273}
+    WINDOW = re.compile(r"^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})$")
+
+    def __init__(self, windows):
+        self.windows = windows  # lista di (inizio, fine, byte/s o None, classe, livello) con gli orari in minuti
+        self.lock = threading.Lock()
+        self.local = threading.local()  # priorità impostata sul thread corrente
+        self.current = None
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.window_bytes = 0
+        self.window_start = time.monotonic()
+        self.syscall = None
+        if platform.machine() in self.SYS_IOPRIO_SET:
+            self.syscall = ctypes.CDLL(None, use_errno=True).syscall
+
+    @classmethod
+    def from_configuration(cls, configuration):
+        """ Legge [throttle] schedule: fasce 'HH:MM-HH:MM <MB/s> <classe>[:<livello>]' separate da ',',
+            dove 0 MB/s indica nessun limite. Ritorna None se non ci sono fasce """
+        if not configuration.exists("throttle", "schedule"):
+            return None
+        windows = []
+        for entry in configuration.get_as_list("throttle", "schedule"):
+            if not entry:
+                continue
+            fields = entry.split()
+            match = cls.WINDOW.match(fields[0])
+            if match is None or len(fields) > 3:
+                raise ValueError("Fascia oraria non valida in [throttle] schedule: '{}'".format(entry))
+            start = int(match.group(1)) * 60 + int(match.group(2))
+            end = int(match.group(3)) * 60 + int(match.group(4))
+            rate = float(fields[1]) * 1024 * 1024 if len(fields) > 1 else 0
+            io_class, _, level = (fields[2] if len(fields) > 2 else "none").partition(":")
+            if io_class not in cls.IOPRIO_CLASSES:
+                raise ValueError("Classe di I/O non valida in [throttle] schedule: '{}'".format(io_class))
+            # il livello vale solo per realtime e best-effort: con none il kernel rifiuta un livello diverso da 0
+            level = int(level or 4) if io_class in ("realtime", "best-effort") else 0
+            windows.append((start, end, rate or None, io_class, level))
+        return cls(windows) if windows else None
+
+    def active(self):
+        """ Ritorna la fascia in corso oppure None. Una fascia che finisce prima di iniziare scavalca la mezzanotte """
+        now = datetime.now()
+        minute = now.hour * 60 + now.minute
+        for window in self.windows:
+            start, end = window[0], window[1]
+            if start <= minute < end or (end <= start and (minute >= start or minute < end)):
+                return window
+        return None
 
     @staticmethod
-    def get_size(file):
-        """ Ritorna la dimensione in GB del file"""
-        metadata = os.stat(file)
-        file_size = round(metadata.st_size / 1024 / 1024 / 1024, 2)
-        return file_size
+    def describe(window):
+        if window is None:
+            return "nessun limite, priorità predefinita"
+        return "{} MB/s, priorità {}".format(
+            round(window[2] / 1024 / 1024, 2) if window[2] else "nessun limite",
+            window[3] if window[3] in ("none", "idle") else "{}:{}".format(window[3], window[4])
+        )
+
+    def consume(self, size):
+        """ Registra 'size' byte letti dalla sorgente e attende quanto serve per rispettare il limite della fascia """
+        window = self.active()
+        self.set_priority(window)
+        with self.lock:
+            if window is not self.current:
+                self.switch(window)
+            self.window_bytes += size
+            rate = window[2] if window is not None else None
+            if rate is None:
+                return
+            now = time.monotonic()
+            # il secchio contiene al massimo un secondo di dati: i thread in debito attendono a turno
+            self.tokens = min(rate, self.tokens + (now - self.updated) * rate) - size
+            self.updated = now
+            delay = -self.tokens / rate if self.tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+    def switch(self, window):
+        """ Passa a una nuova fascia riportando nel log la velocità effettiva di quella precedente """
+        if self.window_bytes:
+            self.summary()
+        self.log.info(
+            "Fascia oraria %s: %s",
+            "%02d:%02d-%02d:%02d" % (window[0] // 60, window[0] % 60, window[1] // 60, window[1] % 60)
+            if window is not None else "libera", self.describe(window)
+        )
+        self.current = window
+        self.tokens = 0.0
+        self.updated = self.window_start = time.monotonic()
+        self.window_bytes = 0
+
+    def summary(self):
+        """ Riporta nel log la velocità effettiva delle copie nella fascia corrente """
+        seconds = time.monotonic() - self.window_start
+        self.log.info(
+            "Velocità effettiva ( %s ): %s MB in %s s, %s MB/s",
+            self.describe(self.current), round(self.window_bytes / 1024 / 1024, 2), round(seconds, 1),
+            round(self.window_bytes / 1024 / 1024 / seconds, 2) if seconds else "-"
+        )
+
+    def set_priority(self, window):
+        """ Imposta la priorità di I/O della fascia sul thread corrente ( ioprio è per thread ) """
+        wanted = (window[3], window[4]) if window is not None else ("none", 0)
+        if getattr(self.local, "priority", ("none", 0)) == wanted:
+            return
+        self.local.priority = wanted
+        io_class = self.IOPRIO_CLASSES[wanted[0]]
+        if self.syscall is not None:
+            value = io_class << self.IOPRIO_CLASS_SHIFT | wanted[1]
+            # con who = 0 il kernel applica la priorità al solo thread chiamante
+            if self.syscall(self.SYS_IOPRIO_SET[platform.machine()], self.IOPRIO_WHO_PROCESS, 0, value) == 0:
+                return
+            self.log.debug("ioprio_set non riuscita: %s", os.strerror(ctypes.get_errno()))
+        command = ["ionice", "-c", str(io_class), "-p", str(threading.get_native_id())]
+        if wanted[0] in ("realtime", "best-effort"):
+            command[3:3] = ["-n", str(wanted[1])]
+        try:
+            result = run(command, stdout=PIPE, stderr=STDOUT)
+        except OSError as error:
+            self.log.warning("Impossibile impostare la priorità di I/O: %s", error)
+            return
+        if result.returncode:
+            self.log.warning("Impossibile impostare la priorità di I/O: %s", result.stdout.decode().strip())
+
+
+class TransferEngine:
+    """ Motore di spostamento in-process: sullo stesso filesystem effettua un rename, altrimenti copia
+        lato kernel con copy_file_range/sendfile (con fallback a buffer) e cancella la sorgente
+        solo dopo che la copia è completa e scritta su disco """
+
+    log = logging.getLogger('transfer')
+    null_handler = logging.NullHandler()
+    log.addHandler(null_handler)
+
+    # errori per cui la copia lato kernel non è supportata e si passa al metodo successivo
+    FALLBACK_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF)
+
+    # ioctl FICLONERANGE ( linux/fs.h ): condivide un intervallo di un file con un altro senza copiare i dati
+    FICLONERANGE = 0x4020940d
+    CLONE_RANGE = struct.Struct("=qQQQ")
+
+    # fallocate(2) che riserva lo spazio senza cambiare la dimensione del file
+    FALLOC_FL_KEEP_SIZE = 0x01
+    # con O_DIRECT posizione e lunghezza delle scritture devono essere multipli del blocco logico del disco
+    DIRECT_ALIGN = 4096
+    # byte copiati tra un rilascio della cache e l' altro
+    DROP_WINDOW = 64 * 1024 * 1024
+
+    def __init__(self, configuration):
+        self.configuration = configuration
+        buffer_mb = 8
+        if self.configuration.exists("transfer", "buffer_size"):
+            buffer_mb = int(self.configuration.get("transfer", "buffer_size"))
+        self.buffer_size = buffer_mb * 1024 * 1024
+        self.compressor = GzipCompressor.from_configuration(configuration)
+        self.algorithm = None
+        if self.configuration.exists("verify", "algorithm"):
+            self.algorithm = self.configuration.get("verify", "algorithm").strip().lower() or None
+        if self.algorithm:
+            hashlib.new(self.algorithm)  # un algoritmo non valido blocca subito l' esecuzione
+        self.readback = self.configuration.is_enabled("verify", "readback")
+        self.journal = TransferJournal.from_configuration(configuration)
+        # I/O che non invade la cache del server e non frammenta il disco esterno
+        self.preallocate = self.configuration.is_enabled("transfer", "preallocate")
+        self.drop_cache = self.configuration.is_enabled("transfer", "drop_cache")
+        self.direct = self.configuration.is_enabled("transfer", "direct")
+        self.fallocate = None
+        if self.preallocate:
+            libc = ctypes.CDLL(None, use_errno=True)
+            self.fallocate = getattr(libc, "fallocate64", None) or libc.fallocate
+            self.fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+        self.throttle = Throttle.from_configuration(configuration)
+        # copia delta: dimensione dei blocchi confrontati con l' archivio precedente, None se disabilitata
+        self.delta_block_size = None
+        if self.configuration.is_enabled("delta", "enabled"):
+            block_kb = 1024
+            if self.configuration.exists("delta", "block_size"):
+                block_kb = int(self.configuration.get("delta", "block_size"))
+            self.delta_block_size = block_kb * 1024
+            if self.compressor is not None:
+                self.log.warning("Con la copia delta attiva gli archivi non vengono compressi")
+
+    def move(self, source, dest, previous=None, store=None):
+        """ Sposta il file sorgente nella destinazione e ritorna l' hash del file scritto
+            (None se la verifica è disabilitata). previous è l' archivio precedente dello stesso file usato
+            dalla copia delta, store il deposito deduplicato in cui salvare il file al posto della copia.
+            In caso di errore solleva OSError e la sorgente resta intatta """
+        if self.throttle is not None:
+            self.throttle.consume(0)  # priorità di I/O della fascia in corso prima di leggere la sorgente
+        if store is not None:
+            compress = self.compressor is not None and self.compressor.should_compress(source)
+            checksum = store.store(source, dest, self.compressor if compress else None, self.algorithm, self.throttle)
+            os.unlink(source)
+            return checksum
+        compress = (self.compressor is not None and self.delta_block_size is None
+                    and self.compressor.should_compress(source))
+        if not compress:
+            try:
+                os.rename(source, dest)
+                self.log.debug("'%s' spostato con rename", source)
+                checksum = None
+                if self.algorithm:
+                    checksum = self.hash_file(dest)
+                    self.write_manifest(dest, checksum)
+                if self.delta_block_size is not None:
+                    BlockSignature.build(dest, self.delta_block_size).save(dest)
+                return checksum
+            except OSError as error:
+                if error.errno != errno.EXDEV:
+                    raise
+        checksum = self.copy(source, dest, compress, previous)
+        os.unlink(source)
+        return checksum
+
+    def copy(self, source, dest, compress=False, previous=None):
+        """ Copia il file (comprimendolo se richiesto) in '<dest>.part' calcolando l' hash dei dati mentre
+            vengono scritti, poi lo rinomina in modo atomico. Ritorna l' hash oppure None se la verifica è
+            disabilitata. In caso di errore solleva OSError: la copia parziale resta su disco solo se il
+            giornale permette di riprenderla """
+        signature = None
+        with open(source, "rb", buffering=0) as src:
+            metadata = os.fstat(src.fileno())
+            progress = TransferProgress(self, source, dest, metadata, compress)
+            progress.src_fd = src.fileno()
+            dst = progress.open()
+            try:
+                with dst:
+                    src.seek(progress.src_offset)
+                    if self.preallocate and not compress and self.delta_block_size is None:
+                        self.allocate(dst.fileno(), progress.dst_offset, progress.entry["size"] - progress.dst_offset)
+                    if compress:
+                        copied, written = self.compressor.compress_stream(src, progress.write)
+                        self.log.info(
+                            "'%s' compresso: %s MB -> %s MB",
+                            os.path.basename(source), round(copied / 1024 / 1024, 2), round(written / 1024 / 1024, 2)
+                        )
+                    elif self.delta_block_size is not None:
+                        signature = self.delta_copy(src, progress, previous)
+                    elif self.direct and progress.dst_offset % self.DIRECT_ALIGN == 0:
+                        self.direct_copy(src, progress)
+                    elif progress.digest is not None:
+                        # per calcolare l' hash i dati devono passare in user space
+                        self._buffer_copy(src, progress.write)
+                    else:
+                        self.copy_fd(src, progress)
+                    os.fsync(dst.fileno())
+                    if self.drop_cache:
+                        progress.drop_cache()
+                checksum = progress.checksum()
+            except BaseException:
+                if self.journal is None:
+                    os.unlink(progress.part)
+                elif not progress.checkpointed:
+                    self.journal.discard(dest)
+                raise
+        try:
+            if checksum is not None and self.readback:
+                self.verify(progress.part, checksum)
+            self.copy_metadata(source, progress.part, metadata)
+            os.replace(progress.part, dest)
+            self.fsync_dir(os.path.dirname(dest))
+            if checksum is not None:
+                self.write_manifest(dest, checksum)
+            if signature is not None:
+                signature.save(dest)
+        except BaseException:
+            for path in (progress.part, dest):
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            if self.journal is not None:
+                self.journal.remove(dest)
+            raise
+        if self.journal is not None:
+            self.journal.remove(dest)
+        self.log.debug("Copiati %s byte da '%s' a '%s'", progress.src_offset, source, dest)
+        return checksum
+
+    def copy_fd(self, src, progress):
+        """ Copia il contenuto da src al file parziale partendo dalle posizioni correnti """
+        if not self._kernel_copy(src.fileno(), progress.dst.fileno(), progress.advance):
+            self._buffer_copy(src, progress.write)
+
+    def allocate(self, fd, offset, length):
+        """ Riserva in un' unica volta lo spazio del file così l' archivio resta contiguo sul disco esterno.
+            Usa fallocate(2) e non posix_fallocate: dove la preallocazione non è supportata ( es. exfat )
+            la glibc la simulerebbe scrivendo tutto il file, raddoppiando le scritture sul disco USB """
+        if length <= 0:
+            return
+        if self.fallocate(fd, self.FALLOC_FL_KEEP_SIZE, offset, length) != 0:
+            error = ctypes.get_errno()
+            if error not in (errno.EOPNOTSUPP, errno.ENOSYS):
+                raise OSError(error, os.strerror(error))
+            self.log.debug("Preallocazione non supportata dal disco esterno")
+
+    def direct_copy(self, src, progress):
+        """ Copia scrivendo con O_DIRECT, così i dati non passano dalla cache del server. Il buffer è allineato
+            alla pagina ( mmap ) e ogni scrittura è un multiplo di DIRECT_ALIGN tranne l' ultima, scritta
+            senza O_DIRECT. Se il filesystem non supporta O_DIRECT copia con il buffer normale """
+        fd = progress.dst.fileno()
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        try:
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_DIRECT)
+        except OSError as error:
+            self.log.debug("O_DIRECT non supportato dal disco esterno (%s), copio con la cache", error)
+            self._buffer_copy(src, progress.write)
+            return
+        size = max(self.DIRECT_ALIGN, self.buffer_size - self.buffer_size % self.DIRECT_ALIGN)
+        buffer = mmap.mmap(-1, size)
+        view = memoryview(buffer)
+        try:
+            while True:
+                read = 0
+                while read < size:
+                    # le porzioni del buffer vanno rilasciate anche in caso di errore, altrimenti il buffer
+                    # non si può chiudere e l' errore originale verrebbe sostituito da un BufferError
+                    with view[read:] as chunk:
+                        count = src.readinto(chunk)
+                    if not count:
+                        break
+                    read += count
+                if not read:
+                    return
+                if read % self.DIRECT_ALIGN:
+                    fcntl.fcntl(fd, fcntl.F_SETFL, flags)  # ultimo blocco non allineato
+                with view[:read] as chunk:
+                    progress.write(chunk)
+                if read < size:
+                    return
+        finally:
+            view.release()
+            buffer.close()
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+
+    def delta_copy(self, src, progress, previous=None):
+        """ Copia a blocchi allineati confrontando ogni blocco con la firma dell' archivio precedente:
+            i blocchi già presenti vengono clonati dall' archivio precedente sul disco esterno ( reflink,
+            nessun dato scritto ), gli altri vengono scritti. Ritorna la firma del nuovo archivio """
+        block_size = self.delta_block_size
+        signature = BlockSignature(block_size)
+        dst_fd = progress.dst.fileno()
+        # ripresa di una copia interrotta: la firma dei blocchi già scritti viene ricalcolata dal file parziale
+        offset = 0
+        while offset < progress.dst_offset:
+            block = os.pread(dst_fd, min(block_size, progress.dst_offset - offset), offset)
+            if not block:
+                break
+            signature.add(block)
+            offset += len(block)
+        reference = None
+        if previous is not None and os.path.exists(previous):
+            reference = BlockSignature.for_archive(previous, block_size)
+        if reference is None:
+            for block in iter(lambda: src.read(block_size), b""):
+                signature.add(block)
+                progress.write(block)
+            return signature
+        cloned = written = 0
+        with open(previous, "rb", buffering=0) as base:
+            clone = True
+            for block in iter(lambda: src.read(block_size), b""):
+                signature.add(block)
+                index = reference.find(block) if clone and len(block) == block_size else None
+                if index is not None:
+                    try:
+                        self.clone_range(base.fileno(), index * block_size, block_size, dst_fd, progress.dst_offset)
+                        progress.skip(block)
+                        cloned += block_size
+                        continue
+                    except OSError as error:
+                        if error.errno not in self.FALLBACK_ERRORS + (errno.ENOTTY,):
+                            raise
+                        # filesystem senza reflink ( ext4, exfat, ntfs ): clonare costerebbe più che scrivere
+                        self.log.info("Il disco esterno non supporta la clonazione dei blocchi (%s), "
+                                      "copio i dati per intero", error)
+                        clone = False
+                progress.write(block)
+                written += len(block)
+        self.log.info(
+            "Copia delta di '%s': %s MB riutilizzati da '%s', %s MB scritti",
+            os.path.basename(progress.entry["source"]), round(cloned / 1024 / 1024, 2),
+            os.path.basename(previous), round(written / 1024 / 1024, 2)
+        )
+        return signature
+
+    @classmethod
+    def clone_range(cls, src_fd, src_offset, length, dst_fd, dst_offset):
+        """ Condivide 'length' byte di src a partire da src_offset nel file di destinazione a dst_offset """
+        fcntl.ioctl(dst_fd, cls.FICLONERANGE, cls.CLONE_RANGE.pack(src_fd, src_offset, length, dst_offset))
+
+    @staticmethod
+    def fsync_dir(path):
+        """ Rende durevole il rename all' interno della cartella """
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def hash_file(self, path, drop_cache=False):
+        """ Calcola l' hash di un file. Con drop_cache il file viene prima tolto dalla cache
+            così da leggerlo davvero dal disco """
+        digest = hashlib.new(self.algorithm)
+        with open(path, "rb", buffering=0) as file:
+            if drop_cache:
+                os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+            self._buffer_copy(file, digest.update)
+        return digest.hexdigest()
+
+    def verify(self, dest, checksum):
+        """ Rilegge il file dal disco esterno e confronta l' hash con quello calcolato durante la copia """
+        self.log.info("Verifico '%s' rileggendolo dal disco", os.path.basename(dest))
+        if self.hash_file(dest, drop_cache=True) != checksum:
+            raise OSError(errno.EIO, "Hash del file copiato non corrispondente", dest)
+
+    def sidecars(self, dest):
+        """ Ritorna i file accessori scritti accanto all' archivio """
+        sidecars = ["{}.{}".format(dest, self.algorithm)] if self.algorithm else []
+        if self.delta_block_size is not None:
+            sidecars.append(BlockSignature.path(dest))
+        return sidecars
+
+    def write_manifest(self, dest, checksum):
+        """ Scrive accanto al file il manifest con l' hash nel formato di sha256sum/b2sum ( '<hash>  <nome>' ) """
+        manifest = "{}.{}".format(dest, self.algorithm)
+        tmp_path = manifest + ".tmp"
+        with open(tmp_path, "w") as file:
+            file.write("{}  {}\n".format(checksum, os.path.basename(dest)))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, manifest)
+
+    def _kernel_copy(self, src_fd, dst_fd, advance):
+        """ Copia zero-copy con copy_file_range e in subordine sendfile. Dopo ogni blocco chiama advance
+            con i byte copiati. Ritorna True oppure False se nessuno dei due metodi è utilizzabile """
+        methods = []
+        if hasattr(os, "copy_file_range"):
+            methods.append(lambda: os.copy_file_range(src_fd, dst_fd, self.buffer_size))
+        if hasattr(os, "sendfile"):
+            methods.append(lambda: os.sendfile(dst_fd, src_fd, None, self.buffer_size))
+        for method in methods:
+            copied = 0
+            try:
+                while True:
+                    sent = method()
+                    if sent == 0:
+                        return True
+                    copied += sent
+                    advance(sent)
+            except OSError as error:
+                # se qualcosa è già stato scritto non posso ripartire da capo con un altro metodo
+                if copied or error.errno not in self.FALLBACK_ERRORS:
+                    raise
+                self.log.debug("Copia lato kernel non disponibile (%s), provo il metodo successivo", error)
+        return False
+
+    def _buffer_copy(self, src, write):
+        """ Copia classica read/write con un buffer di grandi dimensioni riutilizzato.
+            I dati letti vengono passati alla funzione write """
+        buffer = bytearray(self.buffer_size)
+        view = memoryview(buffer)
+        copied = 0
+        while True:
+            read = src.readinto(buffer)
+            if not read:
+                return copied
+            write(view[:read])
+            copied += read
+
+    @staticmethod
+    def write_all(dst, data):
+        """ Scrive tutti i dati gestendo le scritture parziali """
+        written = 0
+        while written < len(data):
+            written += dst.write(data[written:])
+
+    def copy_metadata(self, source, dest, metadata=None):
+        """ Preserva permessi, date e proprietario come /usr/bin/mv. I filesystem che non li
+            supportano (es. vfat) non bloccano la copia. metadata è il risultato di os.stat della sorgente """
+        if metadata is None:
+            metadata = os.stat(source)
+        try:
+            shutil.copystat(source, dest)
+        except OSError as error:
+            self.log.debug("Impossibile preservare permessi e date di '%s': %s", dest, error)
+            os.utime(dest, ns=(metadata.st_atime_ns, metadata.st_mtime_ns))
+        try:
+            os.chown(dest, metadata.st_uid, metadata.st_gid)
+        except OSError as error:
+            self.log.debug("Impossibile preservare il proprietario di '%s': %s", dest, error)
+
+
+class ContentChunker:
+    """ Divisione di un file in blocchi di dimensione variabile definiti dal contenuto: un confine cade dopo
+        ogni occorrenza del marcatore i cui byte precedenti hanno un crc32 multiplo di 'ratio'. Dato che il
+        confine dipende solo dai dati vicini, un inserimento sposta i confini solo localmente e i blocchi
+        successivi restano uguali. La ricerca del marcatore con bytes.find avviene in C, quindi la divisione
+        non rallenta la copia come un hash che scorre byte per byte in Python """
+
+    MARKER = b"\x9d\x4b"
+    WINDOW = 32
+
+    def __init__(self, average=1024 * 1024):
+        self.min_size = max(self.WINDOW, average // 4)
+        self.max_size = average * 4
+        # su dati casuali il marcatore compare in media ogni 64 KB: il crc32 ne tiene uno ogni 'ratio'
+        self.ratio = max(1, (average - self.min_size) // 65536)
+
+    def boundary(self, buffer, limit):
+        """ Ritorna la lunghezza del primo blocco contenuto in buffer[:limit] """
+        position = self.min_size
+        while True:
+            position = buffer.find(self.MARKER, position, limit)
+            if position < 0:
+                return limit
+            if zlib.crc32(buffer[position - self.WINDOW:position]) % self.ratio == 0:
+                return position + len(self.MARKER)
+            position += 1
+
+    def split(self, read):
+        """ Legge i dati con read(n) e ritorna i blocchi uno alla volta """
+        buffer = bytearray()
+        eof = False
+        while True:
+            while not eof and len(buffer) < self.max_size:
+                data = read(self.max_size)
+                if data:
+                    buffer += data
+                else:
+                    eof = True
+            if not buffer:
+                return
+            limit = min(len(buffer), self.max_size)
+            end = self.boundary(buffer, limit) if limit > self.min_size else limit
+            yield bytes(buffer[:end])
+            del buffer[:end]
+
+
+class ChunkStore:
+    """ Deposito deduplicato sul disco esterno: ogni archivio viene diviso in blocchi definiti dal contenuto
+        salvati una sola volta in '<mount_point>/.chunks' con il loro hash come nome. Al posto dell' archivio
+        viene scritta la ricetta '<archivio>.recipe' con l' elenco dei blocchi. L' indice SQLite tiene per ogni
+        blocco dimensione e numero di ricette che lo usano: un blocco viene cancellato quando l' ultima ricetta
+        che lo usa viene eliminata. Le ricette hanno una prima riga JSON con i dati dell' archivio e poi una
+        riga '<hash> <byte>' per blocco """
+
+    log = logging.getLogger('dedup')
+    null_handler = logging.NullHandler()
+    log.addHandler(null_handler)
+
+    DIRECTORY = ".chunks"
+    RECIPE_SUFFIX = ".recipe"
+
+    def __init__(self, mount_point, chunker=None):
+        self.root = os.path.join(mount_point, self.DIRECTORY)
+        self.tmp_dir = os.path.join(self.root, "tmp")
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        self.chunker = chunker or ContentChunker()
+        self.lock = threading.Lock()
+        # blocchi usati dalle copie in corso, non ancora contati nei riferimenti: non vanno eliminati
+        self.pending = {}
+        # l' indice è condiviso dai thread delle copie, gli accessi sono serializzati da self.lock
+        self.db = sqlite3.connect(os.path.join(self.root, "index.db"), check_same_thread=False)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS chunks ("
+                            "hash TEXT PRIMARY KEY, size INTEGER, stored INTEGER, compressed INTEGER, refs INTEGER)")
+
+    @classmethod
+    def from_configuration(cls, configuration, mount_point):
+        """ Apre il deposito del disco se [dedup] enabled è attivo, altrimenti ritorna None """
+        if not configuration.is_enabled("dedup", "enabled"):
+            return None
+        chunk_kb = 1024
+        if configuration.exists("dedup", "chunk_size"):
+            chunk_kb = int(configuration.get("dedup", "chunk_size"))
+        return cls(mount_point, ContentChunker(chunk_kb * 1024))
+
+    @classmethod
+    def recipe_path(cls, archive):
+        return archive if archive.endswith(cls.RECIPE_SUFFIX) else archive + cls.RECIPE_SUFFIX
+
+    def chunk_path(self, key):
+        return os.path.join(self.root, key[:2], key[2:4], key)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def collect(self):
+        """ Elimina i blocchi senza ricette ( scritti da copie interrotte ) e i file temporanei.
+            Va chiamato solo quando nessuna copia è in corso """
+        for name in os.listdir(self.tmp_dir):
+            os.unlink(os.path.join(self.tmp_dir, name))
+        with self.lock:
+            orphans = [row[0] for row in self.db.execute("SELECT hash FROM chunks WHERE refs <= 0")]
+            for key in orphans:
+                try:
+                    os.unlink(self.chunk_path(key))
+                except FileNotFoundError:
+                    pass
+            with self.db:
+                self.db.execute("DELETE FROM chunks WHERE refs <= 0")
+        if orphans:
+            self.log.info("Eliminati %s blocchi non usati da nessuna ricetta", len(orphans))
+
+    def put(self, key, data, compressor=None):
+        """ Salva il blocco se non è già presente. Ritorna i byte scritti sul disco ( 0 se già presente ).
+            Il blocco resta protetto dall' eliminazione finché la copia non lo conta nella sua ricetta """
+        with self.lock:
+            self.pending[key] = self.pending.get(key, 0) + 1
+            if self.db.execute("SELECT 1 FROM chunks WHERE hash = ?", (key,)).fetchone():
+                return 0
+        stored = compressor.compress_block(data) if compressor is not None else data
+        path = self.chunk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = os.path.join(self.tmp_dir, "{}.{}".format(key, threading.get_ident()))
+        with open(tmp_path, "wb") as file:
+            file.write(stored)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+        with self.lock, self.db:
+            self.db.execute("INSERT OR IGNORE INTO chunks VALUES (?, ?, ?, ?, 0)",
+                            (key, len(data), len(stored), compressor is not None))
+        return len(stored)
+
+    def store(self, source, archive, compressor=None, algorithm=None, throttle=None):
+        """ Divide la sorgente in blocchi, salva quelli nuovi e scrive la ricetta dell' archivio.
+            Ritorna l' hash dei dati originali oppure None se la verifica è disabilitata """
+        digest = hashlib.new(algorithm) if algorithm else None
+        chunks = []
+        size = written = 0
+        directories = set()
+        try:
+            with open(source, "rb", buffering=0) as src:
+                for data in self.chunker.split(src.read):
+                    if digest is not None:
+                        digest.update(data)
+                    key = hashlib.blake2b(data, digest_size=32).hexdigest()
+                    chunks.append((key, len(data)))
+                    stored = self.put(key, data, compressor)
+                    if stored:
+                        directories.add(os.path.dirname(self.chunk_path(key)))
+                    size += len(data)
+                    written += stored
+                    if throttle is not None:
+                        throttle.consume(len(data))
+            for directory in directories:
+                TransferEngine.fsync_dir(directory)
+            # prima i riferimenti e poi la ricetta: un' interruzione lascia al massimo blocchi mai eliminati
+            with self.lock, self.db:
+                self.db.executemany("UPDATE chunks SET refs = refs + 1 WHERE hash = ?", [(key,) for key, _ in chunks])
+        finally:
+            with self.lock:
+                for key, _ in chunks:
+                    self.pending[key] -= 1
+                    if not self.pending[key]:
+                        del self.pending[key]
+        header = {
+            "source": os.path.basename(source),
+            "size": size,
+            "chunks": len(chunks),
+            "written": written,
+            "compressed": compressor is not None,
+            "algorithm": algorithm,
+            "checksum": digest.hexdigest() if digest is not None else None,
+        }
+        recipe = self.recipe_path(archive)
+        tmp_path = recipe + ".tmp"
+        with open(tmp_path, "w") as file:
+            file.write(json.dumps(header) + "\n")
+            file.writelines("{} {}\n".format(key, length) for key, length in chunks)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, recipe)
+        TransferEngine.fsync_dir(os.path.dirname(recipe))
+        self.log.info(
+            "'%s' deduplicato: %s blocchi, %s MB nuovi su %s MB",
+            os.path.basename(source), len(chunks), round(written / 1024 / 1024, 2), round(size / 1024 / 1024, 2)
+        )
+        return header["checksum"]
 
     @staticmethod
-    def get_new_name(file_path):
-        """ genera il nuvo nome del file """
+    def read_recipe(recipe):
+        """ Ritorna (intestazione, lista di (hash, byte)) della ricetta """
+        with open(recipe) as file:
+            header = json.loads(file.readline())
+            chunks = [(key, int(length)) for key, length in (line.split() for line in file)]
+        return header, chunks
+
+    @classmethod
+    def written(cls, archive):
+        """ Byte scritti sul disco per l' archivio: blocchi nuovi più la ricetta """
+        recipe = cls.recipe_path(archive)
+        with open(recipe) as file:
+            header = json.loads(file.readline())
+        return header["written"] + os.path.getsize(recipe)
+
+    def release(self, recipe):
+        """ Toglie i riferimenti della ricetta ed elimina i blocchi non più usati. Ritorna i byte liberati """
+        _, chunks = self.read_recipe(recipe)
+        keys = [(key,) for key, _ in chunks]
+        with self.lock:
+            with self.db:
+                self.db.executemany("UPDATE chunks SET refs = refs - 1 WHERE hash = ?", keys)
+            unused = {}
+            for key in set(key for key, _ in chunks) - set(self.pending):
+                row = self.db.execute("SELECT stored FROM chunks WHERE hash = ? AND refs <= 0", (key,)).fetchone()
+                if row is not None:
+                    unused[key] = row[0]
+            for key in unused:
+                try:
+                    os.unlink(self.chunk_path(key))
+                except FileNotFoundError:
+                    pass
+            with self.db:
+                self.db.executemany("DELETE FROM chunks WHERE hash = ?", [(key,) for key in unused])
+        return sum(unused.values())
+
+    def reclaimable(self, recipes):
+        """ Ritorna i byte dei blocchi che verrebbero liberati eliminando tutte le ricette indicate """
+        uses = {}
+        for recipe in recipes:
+            for key, _ in self.read_recipe(recipe)[1]:
+                uses[key] = uses.get(key, 0) + 1
+        total = 0
+        with self.lock:
+            for key, count in uses.items():
+                if key in self.pending:
+                    continue
+                row = self.db.execute("SELECT stored FROM chunks WHERE hash = ? AND refs <= ?", (key, count)).fetchone()
+                if row is not None:
+                    total += row[0]
+        return total
+
+    def restore(self, recipe, output):
+        """ Ricostruisce l' archivio della ricetta in output verificando ogni blocco. Ritorna i byte scritti """
+        header, chunks = self.read_recipe(recipe)
+        digest = hashlib.new(header["algorithm"]) if header.get("algorithm") else None
+        written = 0
+        tmp_path = output + ".part"
+        with open(tmp_path, "wb") as file:
+            for key, _ in chunks:
+                with self.lock:
+                    row = self.db.execute("SELECT compressed FROM chunks WHERE hash = ?", (key,)).fetchone()
+                if row is None:
+                    raise OSError(errno.ENOENT, "Blocco mancante nel deposito", self.chunk_path(key))
+                with open(self.chunk_path(key), "rb") as chunk:
+                    data = chunk.read()
+                raw = zlib.decompress(data, 31) if row[0] else data
+                if hashlib.blake2b(raw, digest_size=32).hexdigest() != key:
+                    raise OSError(errno.EIO, "Blocco danneggiato", self.chunk_path(key))
+                if digest is not None:
+                    digest.update(raw)
+                if header["compressed"]:
+                    # l' archivio compresso è la concatenazione dei blocchi come membri gzip
+                    data = data if row[0] else zlib.compress(raw, wbits=31)
+                else:
+                    data = raw
+                file.write(data)
+                written += len(data)
+            file.flush()
+            os.fsync(file.fileno())
+        if digest is not None and digest.hexdigest() != header["checksum"]:
+            os.unlink(tmp_path)
+            raise OSError(errno.EIO, "Hash dell' archivio ricostruito non corrispondente", output)
+        os.replace(tmp_path, output)
+        return written
+
+
+class ScanIndex:
+    """ Indice persistente ( SQLite ) dell' albero sorgente: cartelle con la loro data di modifica e
+        sottocartelle, file delle cartelle month con dimensione, data di modifica e inode.
+        Una cartella viene riletta solo se la sua data di modifica è cambiata, quindi le esecuzioni
+        successive toccano solo le cartelle in cui sono stati aggiunti, rimossi o rinominati file.
+        I file modificati senza essere ricreati non cambiano la data della cartella: lo scheduler
+        li intercetta comunque perché ricontrolla ogni file prima di consegnarlo """
+
+    log = logging.getLogger('index')
+    null_handler = logging.NullHandler()
+    log.addHandler(null_handler)
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS dirs ("
+                            "path TEXT PRIMARY KEY, mtime_ns INTEGER, subdirs TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS files ("
+                            "dir TEXT, name TEXT, size INTEGER, mtime REAL, inode INTEGER, "
+                            "PRIMARY KEY (dir, name))")
+        self.rescanned = 0  # cartelle rilette dall' apertura dell' indice
+
+    @classmethod
+    def from_configuration(cls, configuration):
+        """ Apre l' indice indicato in [scan] index ( di default nella cartella dei log ).
+            Ritorna None se l' opzione è presente ma vuota """
+        if configuration.exists("scan", "index"):
+            path = configuration.get("scan", "index").strip()
+            if not path:
+                return None
+        else:
+            path = default_db_path("scan_index.db")
+        try:
+            return cls(path)
+        except sqlite3.Error as error:
+            cls.log.warning("Impossibile aprire l' indice '%s', eseguo la scansione completa: %s", path, error)
+            return None
+
+    def cached_dir(self, path):
+        row = self.db.execute("SELECT mtime_ns, subdirs FROM dirs WHERE path = ?", (path,)).fetchone()
+        return (row[0], json.loads(row[1])) if row else (None, None)
+
+    def forget(self, path):
+        """ Rimuove dall' indice una cartella sparita e tutto il suo contenuto """
+        prefix = path.rstrip("/") + "/%"
+        with self.db:
+            self.db.execute("DELETE FROM dirs WHERE path = ? OR path LIKE ?", (path, prefix))
+            self.db.execute("DELETE FROM files WHERE dir = ? OR dir LIKE ?", (path, prefix))
+
+    def subdirs(self, path):
+        """ Ritorna le sottocartelle di path come lista di (nome, è un link simbolico), rileggendo la cartella
+            solo se è stata modificata. Come os.walk comprende i link a cartelle. Ritorna None se la cartella
+            non esiste più """
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            self.forget(path)
+            return None
+        cached_mtime, cached_subdirs = self.cached_dir(path)
+        # un indice scritto da una versione precedente contiene solo i nomi: la cartella va riletta
+        if cached_mtime == mtime_ns and all(isinstance(item, list) for item in cached_subdirs):
+            return [tuple(item) for item in cached_subdirs]
+        self.rescanned += 1
+        names = []
+        with os.scandir(path) as iterator:
+            for entry in iterator:
+                try:
+                    if entry.is_dir():
+                        names.append((entry.name, entry.is_symlink()))
+                except FileNotFoundError:
+                    continue
+        names.sort()
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)", (path, mtime_ns, json.dumps(names)))
+        return names
+
+    def find_servers(self, source_dir):
+        """ Come os.walk ritorna le cartelle che contengono 'month', anche se è un link, ma rilegge solo
+            le cartelle modificate. Come os.walk non scende nei link a cartelle """
+        servers = []
+        stack = [source_dir.rstrip("/") or "/"]
+        while stack:
+            path = stack.pop()
+            names = self.subdirs(path)
+            if names is None:
+                continue
+            if any(name == "month" for name, _ in names):
+                servers.append(path)
+            stack.extend(os.path.join(path, name) for name, link in reversed(names) if name != "month" and not link)
+        self.log.debug("Trovati %s server, %s cartelle rilette", len(servers), self.rescanned)
+        return servers
+
+    def month_entries(self, srv):
+        """ Ritorna i file della cartella month come TransferScheduler.scan_month,
+            leggendoli dall' indice se la cartella non è stata modificata """
+        month = os.path.join(srv, "month")
+        try:
+            mtime_ns = os.stat(month).st_mtime_ns
+        except FileNotFoundError:
+            self.forget(month)
+            return []
+        cached_mtime, _ = self.cached_dir(month)
+        if cached_mtime == mtime_ns:
+            rows = self.db.execute("SELECT name, mtime, inode, size FROM files WHERE dir = ?", (month,))
+            return [(mtime, os.path.join(month, name), inode, size) for name, mtime, inode, size in rows]
+        self.rescanned += 1
+        entries = TransferScheduler.scan_month(srv)
+        with self.db:
+            self.db.execute("DELETE FROM files WHERE dir = ?", (month,))
+            self.db.executemany(
+                "INSERT INTO files VALUES (?, ?, ?, ?, ?)",
+                [(month, os.path.basename(path), size, mtime, inode) for mtime, path, inode, size in entries]
+            )
+            self.db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)", (month, mtime_ns, "[]"))
+        return entries
+
+
+class Catalog:
+    """ Catalogo persistente ( SQLite ) degli archivi copiati su tutti i dischi esterni: per ogni copia riuscita
+        disco ( UUID ), server, nome originale, nuovo nome, percorso sul disco, dimensione, data di modifica e hash.
+        Gli archivi eliminati dalle politiche di conservazione restano nel catalogo con la data di eliminazione.
+        Permette di sapere su quale disco si trova un archivio senza montare nulla """
+
+    log = logging.getLogger('catalog')
+    null_handler = logging.NullHandler()
+    log.addHandler(null_handler)
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # il catalogo viene aggiornato dai thread delle copie, gli accessi sono serializzati da self.lock
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS archives ("
+                            "uuid TEXT, server TEXT, original TEXT, name TEXT, path TEXT, date TEXT, "
+                            "size INTEGER, stored INTEGER, mtime REAL, checksum TEXT, algorithm TEXT, "
+                            "copied TEXT, evicted TEXT)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS archives_server_date ON archives (server, date)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS archives_name ON archives (name)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS archives_uuid_path ON archives (uuid, path)")
+
+    @classmethod
+    def from_configuration(cls, configuration):
+        """ Apre il catalogo indicato in [catalog] path ( di default nella cartella dei log ).
+            Ritorna None se l' opzione è presente ma vuota """
+        if configuration.exists("catalog", "path"):
+            path = configuration.get("catalog", "path").strip()
+            if not path:
+                return None
+        else:
+            path = default_db_path("catalog.db")
+        try:
+            return cls(path)
+        except sqlite3.Error as error:
+            cls.log.warning("Impossibile aprire il catalogo '%s', le copie non verranno registrate: %s", path, error)
+            return None
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def record(self, uuid, server, original, path, size, stored, mtime, checksum=None, algorithm=None):
+        """ Registra una copia riuscita. path è il percorso dell' archivio relativo al punto di mount:
+            una copia precedente con lo stesso percorso sullo stesso disco viene segnata come sostituita """
+        name = os.path.basename(path)
+        if name.endswith(ChunkStore.RECIPE_SUFFIX):
+            name = name[:-len(ChunkStore.RECIPE_SUFFIX)]
+        date = DestinationIndex.archive_date(name)
+        now = datetime.now().isoformat(timespec="seconds")
+        try:
+            with self.lock, self.db:
+                self.db.execute("UPDATE archives SET evicted = ? WHERE uuid IS ? AND path = ? AND evicted IS NULL",
+                                (now, uuid, path))
+                self.db.execute(
+                    "INSERT INTO archives VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL)",
+                    (uuid, server, original, name, path, date.date().isoformat() if date else None,
+                     size, stored, mtime, checksum, algorithm, now)
+                )
+        except sqlite3.Error as error:
+            self.log.error("Impossibile registrare '%s' nel catalogo: %s", path, error)
+
+    def evict(self, uuid, path):
+        """ Segna come eliminato l' archivio del disco indicato """
+        try:
+            with self.lock, self.db:
+                self.db.execute("UPDATE archives SET evicted = ? WHERE uuid IS ? AND path = ? AND evicted IS NULL",
+                                (datetime.now().isoformat(timespec="seconds"), uuid, path))
+        except sqlite3.Error as error:
+            self.log.error("Impossibile aggiornare '%s' nel catalogo: %s", path, error)
+
+    def find(self, text=None, date=None, include_evicted=False):
+        """ Ritorna gli archivi il cui server o nome contiene 'text', con data dell' archivio 'date' ( AAAA-MM-GG ) """
+        query = "SELECT uuid, server, original, path, date, size, stored, checksum, copied, evicted FROM archives"
+        conditions, params = [], []
+        if text:
+            conditions.append("(server LIKE ? OR name LIKE ?)")
+            params += ["%{}%".format(text)] * 2
+        if date:
+            conditions.append("date = ?")
+            params.append(date)
+        if not include_evicted:
+            conditions.append("evicted IS NULL")
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        with self.lock:
+            return self.db.execute(query + " ORDER BY server, date", params).fetchall()
+
+    def usage(self):
+        """ Ritorna per ogni disco (uuid, archivi, byte originali, byte occupati, ultima copia) degli archivi presenti """
+        with self.lock:
+            return self.db.execute(
+                "SELECT uuid, COUNT(*), SUM(size), SUM(stored), MAX(copied) FROM archives "
+                "WHERE evicted IS NULL GROUP BY uuid ORDER BY uuid"
+            ).fetchall()
+
+
+class TransferScheduler:
+    """ Pianifica l' ordine dei trasferimenti. Le cartelle 'month' vengono lette una sola volta con
+        os.scandir e per ogni server viene costruito un heap ordinato per data di modifica.
+        I server vengono serviti a turno e per ognuno viene restituito sempre il file più vecchio """
+
+    log = logging.getLogger('scheduler')
+    null_handler = logging.NullHandler()
+    log.addHandler(null_handler)
+
+    def __init__(self, srv_path_all, index=None):
+        self.srv_path_all = srv_path_all
+        self.index = index    # ScanIndex opzionale: le cartelle month non modificate non vengono rilette
+        self.queues = {}      # server -> heap di (mtime, path)
+        self.turn = deque()   # server con almeno un file in coda, nell' ordine in cui vengono serviti
+        self.handed_out = set()  # file già consegnati, identificati da (path, inode, mtime)
+        self.scan()
+
+    @staticmethod
+    def stat_month(srv):
+        """ Legge la cartella month del server con una sola scandir e ritorna la lista (path, stat) """
+        entries = []
+        try:
+            with os.scandir(os.path.join(srv, "month")) as iterator:
+                for entry in iterator:
+                    if entry.name.startswith("."):  # come glob("month/*") ignoro i file nascosti
+                        continue
+                    try:
+                        if not entry.is_file():
+                            continue
+                        entries.append((entry.path, entry.stat()))
+                    except FileNotFoundError:  # file sparito durante la scansione
+                        continue
+        except FileNotFoundError:
+            pass
+        return entries
+
+    @classmethod
+    def scan_month(cls, srv):
+        """ Ritorna i file della cartella month del server come lista (mtime, path, inode, size) """
+        return [(metadata.st_mtime, path, metadata.st_ino, metadata.st_size) for path, metadata in cls.stat_month(srv)]
+
+    def scan(self):
+        """ Scansiona tutte le cartelle month e ricostruisce le code. Ritorna il numero di file trovati """
+        self.queues = {}
+        self.turn = deque()
+        found = 0
+        for srv in self.srv_path_all:
+            entries = self.index.month_entries(srv) if self.index is not None else self.scan_month(srv)
+            heap = [(mtime, path) for mtime, path, inode, _ in entries
+                    if (path, inode, mtime) not in self.handed_out]
+            if heap:
+                heapq.heapify(heap)
+                self.queues[srv] = heap
+                self.turn.append(srv)
+                found += len(heap)
+        self.log.debug("Scansione completata: %s file in %s server", found, len(self.turn))
+        return found
+
+    def next_file(self, busy=()):
+        """ Ritorna (server, path, stat) del prossimo file da copiare oppure None se non ci sono più file
+            oppure se tutti i server rimasti sono in 'busy' (copia già in corso).
+            Quando le code sono vuote viene effettuata una nuova scansione per intercettare i file
+            arrivati durante l' esecuzione """
+        while True:
+            if not self.turn and not self.scan():
+                return None
+            free = [srv for srv in self.turn if srv not in busy]
+            if not free:
+                return None
+            srv = free[0]
+            self.turn.remove(srv)
+            heap = self.queues[srv]
+            mtime, path = heapq.heappop(heap)
+            if heap:
+                self.turn.append(srv)
+            try:
+                metadata = os.stat(path)
+            except FileNotFoundError:
+                self.log.debug("Il file '%s' non esiste più, lo ignoro", path)
+                continue
+            if metadata.st_mtime != mtime:
+                # il file è stato modificato dopo la scansione: lo rimetto in coda con la nuova data
+                heapq.heappush(heap, (metadata.st_mtime, path))
+                if srv not in self.turn:
+                    self.turn.append(srv)
+                continue
+            self.handed_out.add((path, metadata.st_ino, metadata.st_mtime))
+            return srv, path, metadata
+
+
+class SpaceLedger:
+    """ Contabilità in memoria dello spazio sul disco esterno. Parte dal valore di shutil.disk_usage,
+        riserva lo spazio di ogni file prima della copia e lo addebita a copia conclusa.
+        Ogni 'reconcile_every' file il valore viene riallineato con quello reale del disco """
+
+    log = logging.getLogger('ledger')
+    null_handler = logging.NullHandler()
+    log.addHandler(null_handler)
+
+    def __init__(self, path, threshold_gb, free=None, reconcile_every=10):
+        self.path = path
+        self.threshold = int(threshold_gb * 1024 * 1024 * 1024)
+        self.reconcile_every = reconcile_every
+        self.lock = threading.Lock()
+        self.reserved = 0   # byte riservati per le copie in corso
+        self.committed = 0  # copie concluse dall' ultimo riallineamento
+        self.used = 0
+        if free is None:
+            self.reconcile()
+        else:
+            self.free = free
+
+    @classmethod
+    def from_configuration(cls, configuration, path, free=None):
+        reconcile_every = 10
+        if configuration.exists("disk", "reconcile"):
+            reconcile_every = max(1, int(configuration.get("disk", "reconcile")))
+        return cls(path, float(configuration.get("disk", "threshold")), free, reconcile_every)
+
+    def reconcile(self):
+        """ Riallinea lo spazio libero con quello reale del disco """
+        _, used, free = shutil.disk_usage(self.path)
+        with self.lock:
+            if self.committed:
+                self.log.debug(
+                    "Riallineo lo spazio libero: stimato %s GB, reale %s GB", bytes_to_gb(self.free), bytes_to_gb(free)
+                )
+            self.used, self.free = used, free
+            self.committed = 0
+
+    def above_threshold(self):
+        with self.lock:
+            return self.free - self.reserved >= self.threshold
+
+    def reserve(self, size):
+        """ Riserva lo spazio per un file. Ritorna False se dopo la copia si scenderebbe sotto la soglia """
+        with self.lock:
+            if self.free - self.reserved - size < self.threshold:
+                return False
+            self.reserved += size
+            return True
+
+    def release(self, size):
+        """ Restituisce lo spazio riservato per una copia non andata a buon fine """
+        with self.lock:
+            self.reserved -= size
+
+    def fits(self, size):
+        """ Ritorna True se un file di 'size' byte entra restando sopra la soglia """
+        with self.lock:
+            return self.free - self.reserved - size >= self.threshold
+
+    def credit(self, size):
+        """ Accredita lo spazio liberato eliminando file dal disco """
+        with self.lock:
+            self.free += size
+            self.used -= size
+
+    def commit(self, size, written):
+        """ Addebita una copia conclusa: 'size' è lo spazio riservato, 'written' quello effettivamente occupato """
+        with self.lock:
+            self.reserved -= size
+            self.free -= written
+            self.used += written
+            self.committed += 1
+            reconcile = self.path is not None and self.committed >= self.reconcile_every
+        if reconcile:
+            self.reconcile()
+
+    def free_gb(self):
+        with self.lock:
+            return bytes_to_gb(self.free - self.reserved)
+
+
+class DestinationIndex:
+    """ Vista indicizzata degli archivi '<server>/*_gg_mm_aaaa.gz' ( o delle loro ricette nel deposito
+        deduplicato ) presenti su un disco di destinazione.
+        Viene costruita con una sola lettura delle cartelle dei server e aggiornata in memoria a ogni copia
+        ed eliminazione: per ogni server un heap ordinato per data dell' archivio ( quella nel nome ) """
+
+    ARCHIVE_NAME = re.compile(r"^(?P<name>.+)_(?P<day>\d{2})_(?P<month>\d{2})_(?P<year>\d{4})\.gz(\.recipe)?$")
+
+    def __init__(self, mount_point):
+        self.mount_point = mount_point
+        self.heaps = {}     # server -> heap di (data, path)
+        self.archives = {}  # path -> (server, byte occupati compresi i file accessori, file accessori, protetto)
+        self.counts = {}    # server -> numero di archivi
+        self.lock = threading.Lock()
+        self.scan()
+
+    @classmethod
+    def archive_date(cls, name):
+        match = cls.ARCHIVE_NAME.match(name)
+        if match is None:
+            return None
+        try:
+            return datetime(int(match.group("year")), int(match.group("month")), int(match.group("day")))
+        except ValueError:
+            return None
+
+    def scan(self):
+        try:
+            servers = [entry for entry in os.scandir(self.mount_point)
+                       if entry.is_dir(follow_symlinks=False) and not entry.name.startswith(".")]
+        except FileNotFoundError:
+            return
+        for server in servers:
+            files = {}
+            with os.scandir(server.path) as iterator:
+                for entry in iterator:
+                    if entry.is_file(follow_symlinks=False):
+                        files[entry.name] = entry.stat(follow_symlinks=False).st_size
+            for name, size in files.items():
+                if self.archive_date(name) is None:
+                    continue
+                # file accessori: manifest e simili, che iniziano con il nome dell' archivio seguito da '.'
+                sidecars = [os.path.join(server.path, other) for other in files
+                            if other.startswith(name + ".")]
+                total = size + sum(files[os.path.basename(path)] for path in sidecars)
+                self.add(server.name, os.path.join(server.path, name), total, sidecars, protected=False)
+
+    def add(self, server, path, size, sidecars=(), protected=True):
+        """ Registra un archivio. Gli archivi protetti ( copiati in questa esecuzione ) non vengono
+            proposti per fare spazio """
+        date = self.archive_date(os.path.basename(path))
+        if date is None:
+            return
+        with self.lock:
+            if path not in self.archives:
+                self.counts[server] = self.counts.get(server, 0) + 1
+            self.archives[path] = (server, size, list(sidecars), protected)
+            heapq.heappush(self.heaps.setdefault(server, []), (date, path))
+
+    def count(self, server):
+        with self.lock:
+            return self.counts.get(server, 0)
+
+    def servers(self):
+        with self.lock:
+            return list(self.heaps)
+
+    def _oldest(self, server, include_protected):
+        """ Ritorna (data, path) del più vecchio archivio del server ancora presente nell' indice """
+        heap = self.heaps.get(server, [])
+        while heap and heap[0][1] not in self.archives:  # voce già eliminata
+            heapq.heappop(heap)
+        if include_protected:
+            return heap[0] if heap else None
+        for date, path in sorted(heap):
+            if path in self.archives and not self.archives[path][3]:
+                return date, path
+        return None
+
+    def pop_oldest(self, server=None, include_protected=False, keep=1):
+        """ Toglie dall' indice l' archivio più vecchio ( del server indicato o di tutto il disco ) senza
+            mai scendere sotto 'keep' archivi per server e ritorna (path, byte occupati, file accessori).
+            Scelta e rimozione avvengono sotto lo stesso lock, così due copie in parallelo non eliminano
+            lo stesso archivio. Ritorna None se non ci sono candidati """
+        with self.lock:
+            servers = [server] if server is not None else list(self.heaps)
+            candidates = []
+            for name in servers:
+                if self.counts.get(name, 0) <= keep:
+                    continue
+                oldest = self._oldest(name, include_protected)
+                if oldest is not None:
+                    candidates.append(oldest)
+            if not candidates:
+                return None
+            path = min(candidates)[1]
+            return (path,) + self._remove(path)
+
+    def evictable(self, keep=1):
+        """ Ritorna (path, byte occupati) degli archivi non protetti che pop_oldest eliminerebbe svuotando
+            il disco fino a lasciare 'keep' archivi per server """
+        with self.lock:
+            result = []
+            for server, heap in self.heaps.items():
+                paths = sorted(set(entry for entry in heap
+                                   if entry[1] in self.archives and not self.archives[entry[1]][3]))
+                count = max(0, self.counts.get(server, 0) - keep)
+                result.extend((path, self.archives[path][1]) for _, path in paths[:count])
+            return result
+
+    def latest(self, server, name):
+        """ Ritorna il path dell' archivio più recente del server con lo stesso nome d' immagine ( la parte
+            che precede la data ) oppure None """
+        with self.lock:
+            candidates = []
+            for date, path in self.heaps.get(server, []):
+                match = self.ARCHIVE_NAME.match(os.path.basename(path))
+                if path in self.archives and match.group("name") == name:
+                    candidates.append((date, path))
+            return max(candidates)[1] if candidates else None
+
+    def older_than(self, date):
+        """ Ritorna gli archivi non protetti con data precedente a 'date' """
+        with self.lock:
+            return [path for path, info in self.archives.items()
+                    if not info[3] and self.archive_date(os.path.basename(path)) < date]
+
+    def _remove(self, path):
+        server, size, sidecars, _ = self.archives.pop(path)
+        self.counts[server] -= 1
+        return size, sidecars
+
+    def remove(self, path):
+        """ Toglie l' archivio dall' indice e ritorna (byte occupati, file accessori) oppure None se
+            nel frattempo è già stato tolto da un' altra copia """
+        with self.lock:
+            if path not in self.archives:
+                return None
+            return self._remove(path)
+
+
+class Target:
+    """ Disco di destinazione: punto di mount, contabilità dello spazio e velocità di scrittura misurata.
+        La velocità è una media mobile dei MB/s delle copie concluse """
+
+    # peso dell' ultima copia nella media mobile della velocità
+    SMOOTHING = 0.3
+
+    def __init__(self, uuid, mount_point, ledger):
+        self.uuid = uuid
+        self.mount_point = mount_point
+        self.ledger = ledger
+        self.throughput = None  # byte/s
+        self.in_flight = 0      # byte delle copie in corso verso questo disco
+        self.index = None       # DestinationIndex, presente solo con una politica di conservazione o la copia delta
+        self.store = None       # ChunkStore, presente solo con la deduplicazione
+        self.lock = threading.Lock()
+
+    def start(self, size):
+        with self.lock:
+            self.in_flight += size
+
+    def finish(self, size, seconds=None):
+        """ Registra la fine di una copia e aggiorna la velocità media se la copia è riuscita """
+        with self.lock:
+            self.in_flight -= size
+            if seconds:
+                speed = size / seconds
+                if self.throughput is None:
+                    self.throughput = speed
+                else:
+                    self.throughput = self.SMOOTHING * speed + (1 - self.SMOOTHING) * self.throughput
+
+    def eta(self, size, default_throughput):
+        """ Tempo stimato per completare le copie in corso più un file di 'size' byte """
+        with self.lock:
+            return (self.in_flight + size) / (self.throughput or default_throughput)
+
+
+class RunMetrics:
+    """ Metriche di un' esecuzione: durata delle fasi ( mount, scansione, copia, ... ) e per ogni file byte,
+        tempo, MB/s e tentativi. A fine esecuzione vengono scritte in un report JSON e in un file di testo
+        per il textfile collector di node_exporter """
+
+    log = logging.getLogger('metrics')
+    null_handler = logging.NullHandler()
+    log.addHandler(null_handler)
+
+    def __init__(self):
+        self.started = time.time()
+        self.stages = {}  # fase -> secondi
+        self.files = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """ Misura la durata di una fase; più misure della stessa fase vengono sommate """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            with self.lock:
+                self.stages[name] = self.stages.get(name, 0) + elapsed
+
+    def record_file(self, server, source, dest, bytes_read, bytes_written, seconds, retries, ok):
+        with self.lock:
+            self.files.append({
+                "server": server,
+                "source": source,
+                "dest": dest,
+                "bytes_read": bytes_read,
+                "bytes_written": bytes_written,
+                "seconds": round(seconds, 3),
+                "mb_per_s": round(bytes_read / 1024 / 1024 / seconds, 2) if seconds else None,
+                "retries": retries,
+                "ok": ok,
+            })
+
+    def report(self, result):
+        """ Ritorna il report dell' esecuzione come dizionario """
+        with self.lock:
+            files = list(self.files)
+            stages = dict(self.stages)
+        copied = [file for file in files if file["ok"]]
+        bytes_read = sum(file["bytes_read"] for file in copied)
+        copy_seconds = stages.get("copy", 0)
+        servers = {}
+        for file in copied:
+            server = servers.setdefault(file["server"], {"files": 0, "bytes": 0, "seconds": 0})
+            server["files"] += 1
+            server["bytes"] += file["bytes_read"]
+            server["seconds"] = round(server["seconds"] + file["seconds"], 3)
+        return {
+            "result": result,
+            "started": datetime.fromtimestamp(self.started).isoformat(timespec="seconds"),
+            "duration_s": round(time.time() - self.started, 3),
+            "stages": {name: round(seconds, 3) for name, seconds in stages.items()},
+            "totals": {
+                "files_ok": len(copied),
+                "files_failed": len(files) - len(copied),
+                "bytes_read": bytes_read,
+                "bytes_written": sum(file["bytes_written"] for file in copied),
+                "mb_per_s": round(bytes_read / 1024 / 1024 / copy_seconds, 2) if copy_seconds else None,
+                "retries": sum(file["retries"] for file in files),
+            },
+            "servers": servers,
+            "files": files,
+        }
+
+    @staticmethod
+    def write_atomic(path, content):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as file:
+            file.write(content)
+        os.replace(tmp_path, path)
+
+    def textfile(self, report):
+        """ Converte il report nel formato testuale di Prometheus """
+        totals = report["totals"]
+        lines = [
+            "# HELP mover_last_run_timestamp_seconds Inizio dell' ultima esecuzione",
+            "# TYPE mover_last_run_timestamp_seconds gauge",
+            "mover_last_run_timestamp_seconds {}".format(round(self.started)),
+            "# HELP mover_last_run_success 1 se l' ultima esecuzione ha copiato tutti i file",
+            "# TYPE mover_last_run_success gauge",
+            "mover_last_run_success {}".format(
+                1 if report["result"] == "successo" and totals["files_failed"] == 0 else 0
+            ),
+            "# HELP mover_run_duration_seconds Durata dell' ultima esecuzione",
+            "# TYPE mover_run_duration_seconds gauge",
+            "mover_run_duration_seconds {}".format(report["duration_s"]),
+            "# HELP mover_stage_duration_seconds Durata delle fasi dell' ultima esecuzione",
+            "# TYPE mover_stage_duration_seconds gauge",
+        ]
+        lines += ['mover_stage_duration_seconds{{stage="{}"}} {}'.format(name, seconds)
+                  for name, seconds in report["stages"].items()]
+        lines += [
+            "# HELP mover_files Archivi spostati nell' ultima esecuzione",
+            "# TYPE mover_files gauge",
+            'mover_files{{status="ok"}} {}'.format(totals["files_ok"]),
+            'mover_files{{status="failed"}} {}'.format(totals["files_failed"]),
+            "# HELP mover_bytes_read Byte letti dalla sorgente nell' ultima esecuzione",
+            "# TYPE mover_bytes_read gauge",
+            "mover_bytes_read {}".format(totals["bytes_read"]),
+            "# HELP mover_bytes_written Byte scritti sui dischi esterni nell' ultima esecuzione",
+            "# TYPE mover_bytes_written gauge",
+            "mover_bytes_written {}".format(totals["bytes_written"]),
+            "# HELP mover_throughput_bytes_per_second Velocità media della fase di copia",
+            "# TYPE mover_throughput_bytes_per_second gauge",
+            "mover_throughput_bytes_per_second {}".format(
+                round((totals["mb_per_s"] or 0) * 1024 * 1024)
+            ),
+            "# HELP mover_retries Tentativi ripetuti nell' ultima esecuzione",
+            "# TYPE mover_retries gauge",
+            "mover_retries {}".format(totals["retries"]),
+            "# HELP mover_server_duration_seconds Tempo di copia per server",
+            "# TYPE mover_server_duration_seconds gauge",
+        ]
+        lines += ['mover_server_duration_seconds{{server="{}"}} {}'.format(name, server["seconds"])
+                  for name, server in report["servers"].items()]
+        lines += [
+            "# HELP mover_server_bytes Byte copiati per server",
+            "# TYPE mover_server_bytes gauge",
+        ]
+        lines += ['mover_server_bytes{{server="{}"}} {}'.format(name, server["bytes"])
+                  for name, server in report["servers"].items()]
+        return "\n".join(lines) + "\n"
+
+    def write(self, configuration, result):
+        """ Scrive il report JSON ( di default nella cartella dei log ) e il file per node_exporter
+            nei percorsi della sezione [metrics] """
+        report = self.report(result)
+        totals = report["totals"]
+        self.log.info(
+            "Copiati %s file ( %s GB ) a %s MB/s, %s errori, %s tentativi ripetuti",
+            totals["files_ok"], bytes_to_gb(totals["bytes_read"]), totals["mb_per_s"],
+            totals["files_failed"], totals["retries"]
+        )
+        try:
+            report_path = os.path.join(LOG_DIR, "report.json")
+            if configuration.exists("metrics", "report"):
+                report_path = configuration.get("metrics", "report")
+            self.write_atomic(report_path, json.dumps(report, indent=2) + "\n")
+            if configuration.exists("metrics", "textfile"):
+                self.write_atomic(configuration.get("metrics", "textfile"), self.textfile(report))
+        except OSError as error:
+            self.log.error("Impossibile scrivere le metriche: %s", error)
+
+
+class BackupMover:
+
+    log = logging.getLogger('mover')
+    null_handler = logging.NullHandler()
+    log.addHandler(null_handler)
+
+    def __init__(self, targets=None, metrics=None):
+        """ targets è la lista di (uuid, mount point) dei dischi di destinazione,
+            di default il solo mount_point del file di configurazione """
+        self.configuration = Configurator(CONF_PATH)
+        self.metrics = metrics or RunMetrics()
+        self.retries = 0
+        if self.configuration.exists("transfer", "retries"):
+            self.retries = int(self.configuration.get("transfer", "retries"))
+        # politiche di conservazione degli archivi sul disco esterno: keep, age, threshold
+        self.retention = set()
+        if self.configuration.exists("retention", "policy"):
+            self.retention = set(self.configuration.get_as_list("retention", "policy")) - {"", "none"}
+        self.index = ScanIndex.from_configuration(self.configuration)
+        self.catalog = Catalog.from_configuration(self.configuration)
+        self.engine = None
+        self.targets = []
+        try:
+            self.srv_path_all = self.find_servers(SOURCE_DIR, self.index)
+            self.engine = TransferEngine(self.configuration)
+            if targets is None:
+                targets = [(None, self.configuration.get("disk", "mount_point"))]
+            for uuid, mount_point in targets:
+                if self.engine.journal is not None:
+                    self.engine.journal.cleanup(mount_point)
+                ledger = SpaceLedger.from_configuration(self.configuration, mount_point)
+                target = Target(uuid, mount_point, ledger)
+                target.store = ChunkStore.from_configuration(self.configuration, mount_point)
+                if target.store is not None:
+                    target.store.collect()
+                if self.retention or self.engine.delta_block_size is not None:
+                    target.index = DestinationIndex(mount_point)
+                self.targets.append(target)
+        except BaseException:
+            # chiudo catalogo e depositi già aperti, altrimenti i dischi non si possono smontare
+            self.close()
+            raise
+        self.skipped = 0  # file non copiati per mancanza di spazio
+        self.failed = 0   # file la cui copia non è riuscita e che sono rimasti nella cartella month
+
+    def close(self):
+        """ Chiude i depositi deduplicati, così i dischi possono essere smontati, e il catalogo """
+        if self.engine is not None and self.engine.throttle is not None and self.engine.throttle.window_bytes:
+            self.engine.throttle.summary()
+        if self.catalog is not None:
+            self.catalog.close()
+        for target in self.targets:
+            if target.store is not None:
+                target.store.close()
+
+    @staticmethod
+    def find_servers(source_dir, index=None):
+        """ Ritorna le cartelle dei server, cioè quelle che contengono una cartella month """
+        if index is not None:
+            return index.find_servers(source_dir)
+        return [root for root, dirs, _, in os.walk(source_dir) if "month" in dirs]
+
+    def check_threshold(self):
+        """ Controlla lo spazio disponibile in base alla soglia critica: basta un disco sopra la soglia """
+        threshold = int(self.configuration.get("disk", "threshold"))
+        if not any(target.ledger.above_threshold() for target in self.targets):
+            self.log.warning("Lo spazio disponibile è al di sotto della soglia critica")
+            self.log.warning("Soglia impostata a '%s GB'", threshold)
+            return False
+        return True
+
+    def choose_target(self, size):
+        """ Sceglie il disco su cui copiare un file e ne riserva lo spazio. Viene preferito il disco che
+            finirebbe prima tenendo conto delle copie in corso e della velocità misurata, a parità quello
+            con più spazio libero. Ritorna None se il file non entra in nessun disco """
+        known = [target.throughput for target in self.targets if target.throughput]
+        # un disco non ancora misurato viene considerato veloce quanto il migliore, così viene provato subito
+        default_throughput = max(known) if known else 1
+        ranking = sorted(
+            self.targets,
+            key=lambda target: (target.eta(size, default_throughput), -target.ledger.free_gb())
+        )
+        for target in ranking:
+            if target.ledger.reserve(size):
+                target.start(size)
+                return target
+        return None
+
+    @staticmethod
+    def get_new_name(file_path, metadata=None):
+        """ genera il nuvo nome del file. metadata è il risultato di os.stat se già disponibile """
         file = os.path.basename(file_path)
-        metadata = os.stat(file_path)
+        if metadata is None:
+            metadata = os.stat(file_path)
         file_name = file.split(".")[0]
         file_timespamp = metadata.st_mtime
         file_date = datetime.fromtimestamp(file_timespamp)
@@ -418,112 +2452,611 @@ class BackupMover:
         )
         return new_file_name
 
-    def mv(self, source, dest):
-        """ Effettua la copia e ritorna True o False """
-        if not os.path.exists(os.path.dirname(dest)):  # se la cartella nel disco esterno non è presente la creo
-            os.makedirs(os.path.dirname(dest))
-        log.info("Inizio copia di '{}'".format(os.path.basename(source)))
-        mv = call("/usr/bin/mv {} {}".format(source, dest), shell=True)
-        if mv == 0:
-            self.log.info("Copia di '{}' effettuata con successo".format(os.path.basename(source)))
-            return True
-        else:
-            self.log.error(
-                "Qualcosa è andato storto nello spostamento di '{}'"
-                .format(os.path.basename(source))
-            )
-            mv = Popen(
-                "/usr/bin/mv {} {}".format(
-                    source, dest
-                ), shell=True, stdout=PIPE, stderr=STDOUT, universal_newlines=True
+    def mv(self, source, dest, previous=None, target=None, metadata=None):
+        """ Effettua lo spostamento e ritorna True o False. In caso di errore la copia viene ritentata
+            fino a [transfer] retries volte ( con il giornale attivo riparte dall' ultimo checkpoint ).
+            previous è l' archivio precedente usato dalla copia delta, target il disco di destinazione
+            ( per il deposito deduplicato e il catalogo ), metadata il risultato di os.stat della sorgente """
+        os.makedirs(os.path.dirname(dest), exist_ok=True)  # se la cartella nel disco esterno non è presente la creo
+        self.log.info("Inizio copia di '%s'", os.path.basename(source))
+        if metadata is None:
+            metadata = os.stat(source)
+        size = metadata.st_size
+        server = os.path.basename(os.path.dirname(dest))
+        store = target.store if target is not None else None
+        checksum = None
+        start = time.monotonic()
+        for attempt in range(self.retries + 1):
+            try:
+                checksum = self.engine.move(source, dest, previous, store)
+                break
+            except OSError as error:
+                self.log.error(
+                    "Qualcosa è andato storto nello spostamento di '%s'", os.path.basename(source)
+                )
+                self.log.error("Output Errore:\n%s", error)
+                if attempt == self.retries or not os.path.exists(source):
+                    self.metrics.record_file(server, source, dest, size, 0, time.monotonic() - start, attempt, False)
+                    return False
+                self.log.warning("Nuovo tentativo ( %s di %s )", attempt + 1, self.retries)
+        seconds = time.monotonic() - start
+        written = store.written(dest) if store is not None else os.path.getsize(dest)
+        self.metrics.record_file(server, source, dest, size, written, seconds, attempt, True)
+        if self.catalog is not None and target is not None:
+            stored = ChunkStore.recipe_path(dest) if store is not None else dest
+            self.catalog.record(
+                target.uuid, server, os.path.basename(source), os.path.relpath(stored, target.mount_point),
+                size, written, metadata.st_mtime, checksum, self.engine.algorithm
             )
-            self.log.error("Output Errore:\n"
-                           "{}".format(mv.stdout.readlines())
-                           )
+        self.log.info(
+            "Copia di '%s' effettuata con successo ( %s MB/s )",
+            os.path.basename(source), round(size / 1024 / 1024 / seconds, 2) if seconds else "-"
+        )
+        return True
+
+    def evict(self, target, path):
+        """ Elimina dal disco esterno un archivio e i suoi file accessori e ne accredita lo spazio.
+            Se l' archivio è già stato eliminato da un' altra copia non fa nulla """
+        removed = target.index.remove(path)
+        if removed is not None:
+            self.discard(target, path, *removed)
+
+    def evict_oldest(self, target, server=None, include_protected=False, keep=1):
+        """ Elimina l' archivio più vecchio scelto da DestinationIndex.pop_oldest. Ritorna False se non
+            ci sono candidati """
+        removed = target.index.pop_oldest(server, include_protected, keep)
+        if removed is None:
             return False
+        self.discard(target, *removed)
+        return True
 
+    def discard(self, target, path, size, sidecars):
+        """ Cancella i file di un archivio già tolto dall' indice e ne accredita lo spazio """
+        self.log.info(
+            "Elimino '%s' da '%s' per la politica di conservazione",
+            os.path.relpath(path, target.mount_point), target.mount_point
+        )
+        if target.store is not None and path.endswith(ChunkStore.RECIPE_SUFFIX):
+            # lo spazio liberato sono i blocchi usati solo da questa ricetta
+            size += target.store.release(path)
+        if self.catalog is not None:
+            self.catalog.evict(target.uuid, os.path.relpath(path, target.mount_point))
+        for file in [path] + sidecars:
+            try:
+                os.unlink(file)
+            except FileNotFoundError:
+                pass
+        target.ledger.credit(size)
 
-if __name__ == '__main__':
-    # creo logger
-    log = logger()
-    # instanzio classe MountUsb
-    mounter = MountUsb()
-    # # Istanzio Configuratore
-    configuration = Configurator(CONF_PATH)
-    # # genero path di log
-    log_path = os.path.join(LOG_DIR, configuration.get("log", "name"))
-    # se il mounter rilascia True allora posso iniziare il processo di copia
-    if mounter.can_exec_backup():
-        mover = BackupMover()
-        # Per prima cosa Controllo lo spazio libero sul disco
-        space_check = mover.check_threshold()
-        # Primo Loop ( fino a che siamo nella soglia)
-        while space_check:
-            srv_path = mover.check_month_folder()   # lista delle path con almeno un file dentro month
-            # Secondo loop ( Fino a che c'è almeno ancora un file da copiare )
-            while srv_path:
-                # Terzo Loop - Per ogni server tiro giu la lista dei file e seleziono il più vecchio
-                for srv in srv_path:
-                    # nome server
-                    srv_name = os.path.basename(os.path.normpath(srv))
-
-                    file_list = mover.get_file_list(srv)
-                    oldest_file_path = mover.get_oldest_file(file_list)  # estrapolo il più vecchio # PATH SORGENTE (compreso il file
-                    oldest_file_size = mover.get_size(oldest_file_path)
-                    n_file_name = mover.get_new_name(oldest_file_path)
-                    dest_dir = os.path.join(configuration.get("disk", "mount_point"), "{}".format(srv_name))
-                    destination_path = os.path.join(dest_dir, n_file_name)  # PATH DESTINAZIONE (compreso il file )
-                    if oldest_file_size < mover.free_space:
-                        if mover.mv(oldest_file_path, destination_path):
-                            _, _, free_space = disk_usage_gb(configuration.get("disk", "mount_point"))
-                            log.info("Spazio rimasto: '{} GB'\n".format(
-                                round(free_space, 2)
-                            ))
-                            space_check = mover.check_month_folder()
-                            srv_path = mover.check_month_folder()
+    def retention_keep(self):
+        """ Numero di archivi per server da conservare sempre: [retention] keep, almeno 1 """
+        if self.configuration.exists("retention", "keep"):
+            return max(1, int(self.configuration.get("retention", "keep")))
+        return 1
+
+    def apply_retention(self):
+        """ Applica le politiche di conservazione prima della copia: 'age' elimina gli archivi più vecchi di
+            [retention] max_age_days, 'keep' lascia al massimo [retention] keep archivi per server,
+            'threshold' elimina i più vecchi finché il disco non torna sopra la soglia """
+        for target in self.targets:
+            if "age" in self.retention and self.configuration.exists("retention", "max_age_days"):
+                days = int(self.configuration.get("retention", "max_age_days"))
+                cutoff = datetime.now() - timedelta(days=days)
+                for path in sorted(target.index.older_than(cutoff)):
+                    self.evict(target, path)
+            if "keep" in self.retention:
+                for server in target.index.servers():
+                    self.enforce_keep(target, server)
+            if "threshold" in self.retention:
+                while not target.ledger.above_threshold():
+                    if not self.evict_oldest(target, keep=1):
+                        break
+
+    def enforce_keep(self, target, server):
+        """ Lascia sul disco solo gli ultimi [retention] keep archivi del server """
+        keep = self.retention_keep()
+        while target.index.count(server) > keep:
+            if not self.evict_oldest(target, server, include_protected=True, keep=keep):
+                break
+
+    @staticmethod
+    def reclaimable(target):
+        """ Byte che make_room può liberare sul disco lasciando l' ultimo archivio di ogni server """
+        candidates = target.index.evictable(keep=1)
+        total = sum(size for _, size in candidates)
+        if target.store is not None:
+            # per le ricette lo spazio vero sono i blocchi non usati da altre ricette
+            recipes = [path for path, _ in candidates if path.endswith(ChunkStore.RECIPE_SUFFIX)]
+            total += target.store.reclaimable(recipes)
+        return total
+
+    def make_room(self, size):
+        """ Con la politica 'threshold' elimina gli archivi più vecchi ( mai quelli copiati in questa esecuzione
+            né l' ultimo di ogni server ) dal disco con più spazio finché il file non entra. I dischi su cui il
+            file non entrerebbe neanche eliminando tutti gli archivi possibili vengono lasciati intatti.
+            Ritorna True o False """
+        if "threshold" not in self.retention:
+            return False
+        for target in sorted(self.targets, key=lambda target: -target.ledger.free_gb()):
+            if not target.ledger.fits(size) and not target.ledger.fits(size - self.reclaimable(target)):
+                continue
+            while not target.ledger.fits(size):
+                if not self.evict_oldest(target, keep=1):
+                    break
+            if target.ledger.fits(size):
+                return True
+        return False
 
+    def move_file(self, srv, source, metadata, target):
+        """ Sposta un file nella cartella del server sul disco indicato usando il risultato di os.stat già letto.
+            Ritorna True o False """
+        size = metadata.st_size
+        srv_name = os.path.basename(os.path.normpath(srv))
+        new_name = self.get_new_name(source, metadata)
+        destination_path = os.path.join(target.mount_point, srv_name, new_name)
+        previous = None
+        if self.engine.delta_block_size is not None and target.store is None:
+            name = DestinationIndex.ARCHIVE_NAME.match(new_name).group("name")
+            previous = target.index.latest(srv_name, name)
+            if previous == destination_path:
+                previous = None
+        start = time.monotonic()
+        if not self.mv(source, destination_path, previous, target, metadata):
+            target.ledger.release(size)
+            target.finish(size)
+            return False
+        target.finish(size, time.monotonic() - start)
+        if target.store is not None:
+            # nel deposito deduplicato l' archivio è la ricetta: i blocchi vengono liberati quando viene eliminata
+            written = target.store.written(destination_path)
+            destination_path = ChunkStore.recipe_path(destination_path)
+            sidecars = []
+            occupied = os.path.getsize(destination_path)
+        else:
+            sidecars = self.engine.sidecars(destination_path)
+            written = occupied = sum(os.path.getsize(path) for path in [destination_path] + sidecars)
+        target.ledger.commit(size, written)
+        if target.index is not None:
+            target.index.add(srv_name, destination_path, occupied, sidecars)
+            if "keep" in self.retention:
+                self.enforce_keep(target, srv_name)
+        self.log.info("Spazio rimasto su '%s': '%s GB'\n", target.mount_point, target.ledger.free_gb())
+        return True
+
+    def move_all(self, scheduler, workers=1):
+        """ Sposta tutti i file restituiti dallo scheduler con al massimo 'workers' copie in parallelo.
+            Ogni server ha al massimo una copia in corso, così l' ordine dal più vecchio viene mantenuto.
+            Ritorna il numero di file spostati """
+        moved = 0
+        in_flight = {}  # future -> server
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while True:
+                while len(in_flight) < workers:
+                    next_file = scheduler.next_file(busy=set(in_flight.values()))
+                    if next_file is None:
+                        break
+                    srv, source, metadata = next_file
+                    size = metadata.st_size
+                    target = self.choose_target(size)
+                    if target is None and self.make_room(size):
+                        target = self.choose_target(size)
+                    if target is None:
+                        self.log.warning("Non c'è abbastanza spazio per copiare '%s'", os.path.basename(source))
+                        self.skipped += 1
+                        continue
+                    in_flight[pool.submit(self.move_file, srv, source, metadata, target)] = srv
+                if not in_flight:
+                    for target in self.targets:
+                        target.ledger.reconcile()
+                    return moved
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    del in_flight[future]
+                    if future.result():
+                        moved += 1
                     else:
-                        log.warning("Non c'è abbastanza spazio per copiare '{}'".format(os.path.basename(oldest_file_path)))
-                        space_check = mover.check_month_folder()
-                        srv_path = mover.check_month_folder()
+                        self.failed += 1
+
+    def move_pipeline(self, workers=1):
+        """ Come move_all ma a stadi sovrapposti: la lettura delle cartelle month avviene in un thread dedicato
+            mentre le copie già pianificate sono in corso, così il disco non resta fermo durante le operazioni
+            sui metadati. Ogni file viene letto con stat una sola volta. Le cartelle month vengono sempre rilette
+            per intero senza passare da [scan] index, che serve solo a trovare i server.
+            Ritorna il numero di file spostati """
+        return asyncio.run(self._pipeline(workers))
+
+    async def _produce(self, loop, scan_pool, candidates, handed_out):
+        """ Stadio di lettura: per ogni server legge la cartella month e mette in coda (server, path, stat).
+            Dopo l' ultimo file di un server mette in coda (server, None, None), al termine mette in coda None.
+            I file già consegnati in questa esecuzione vengono saltati """
+        for srv in self.srv_path_all:
+            entries = await loop.run_in_executor(scan_pool, TransferScheduler.stat_month, srv)
+            for path, metadata in entries:
+                if (path, metadata.st_ino, metadata.st_mtime) not in handed_out:
+                    await candidates.put((srv, path, metadata))
+            await candidates.put((srv, None, None))
+        await candidates.put(None)
+
+    async def _pipeline(self, workers):
+        """ Stadio di pianificazione: riceve i file dallo stadio di lettura, li ordina per server dal più vecchio,
+            sceglie il disco e li passa agli stadi di copia eseguiti nel pool di thread. Come in move_all ogni
+            server ha al massimo una copia in corso. I file di un server vengono pianificati solo quando la sua
+            cartella è stata letta per intero, così il primo a partire è davvero il più vecchio. A lettura conclusa,
+            se sono arrivati nuovi file la cartella viene riletta, come fa lo scheduler quando le code sono vuote """
+        loop = asyncio.get_running_loop()
+        candidates = asyncio.Queue(maxsize=1024)
+        listing = {}          # server -> file letti finora, finché la cartella non è completa
+        queues = {}           # server -> heap di (mtime, path, stat)
+        turn = deque()        # server con almeno un file in coda, nell' ordine in cui vengono serviti
+        in_flight = {}        # future -> server
+        handed_out = set()    # file già consegnati, identificati da (path, inode, mtime)
+        moved = 0
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="scan") as scan_pool, \
+                ThreadPoolExecutor(max_workers=workers) as pool:
+            producer = loop.create_task(self._produce(loop, scan_pool, candidates, handed_out))
+            getter = loop.create_task(candidates.get())
+            found = 0
+            while True:
+                if getter is not None and getter.done():
+                    # prima di pianificare raccolgo tutti i file già letti
+                    items = [getter.result()]
+                    while True:
+                        try:
+                            items.append(candidates.get_nowait())
+                        except asyncio.QueueEmpty:
+                            break
+                    getter = None if items[-1] is None else loop.create_task(candidates.get())
+                    for item in items:
+                        if item is None:
+                            continue
+                        srv, path, metadata = item
+                        if path is not None:
+                            listing.setdefault(srv, []).append((metadata.st_mtime, path, metadata))
+                            found += 1
+                            continue
+                        # cartella del server letta per intero: i suoi file ora si possono pianificare
+                        entries = listing.pop(srv, [])
+                        if entries:
+                            heap = queues.setdefault(srv, [])
+                            for entry in entries:
+                                heapq.heappush(heap, entry)
+                            if srv not in turn:
+                                turn.append(srv)
+                busy = set(in_flight.values())
+                while len(in_flight) < workers:
+                    free = [srv for srv in turn if srv not in busy]
+                    if not free:
+                        break
+                    srv = free[0]
+                    turn.remove(srv)
+                    mtime, source, metadata = heapq.heappop(queues[srv])
+                    if queues[srv]:
+                        turn.append(srv)
+                    handed_out.add((source, metadata.st_ino, mtime))
+                    size = metadata.st_size
+                    target = self.choose_target(size)
+                    if target is None and self.make_room(size):
+                        target = self.choose_target(size)
+                    if target is None:
+                        self.log.warning("Non c'è abbastanza spazio per copiare '%s'", os.path.basename(source))
+                        self.skipped += 1
+                        continue
+                    future = loop.run_in_executor(pool, self.move_file, srv, source, metadata, target)
+                    in_flight[future] = srv
+                    busy.add(srv)
+                if getter is None and not in_flight and not turn:
+                    await producer
+                    if not found:
+                        break
+                    # rileggo le cartelle per i file arrivati durante la copia
+                    found = 0
+                    producer = loop.create_task(self._produce(loop, scan_pool, candidates, handed_out))
+                    getter = loop.create_task(candidates.get())
+                    continue
+                waiting = set(in_flight) | ({getter} if getter is not None else set())
+                done, _ = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    if future in in_flight:
+                        del in_flight[future]
+                        if future.result():
+                            moved += 1
+                        else:
+                            self.failed += 1
+        for target in self.targets:
+            target.ledger.reconcile()
+        return moved
+
+    def space_report(self):
+        """ Testo con lo spazio libero e occupato dei dischi di destinazione per l' email di fine copia """
+        lines = []
+        for target in self.targets:
+            _, used_space, free_space = disk_usage_gb(target.mount_point)
+            if len(self.targets) > 1:
+                lines.append("Disco '{}':".format(target.uuid))
+            lines.append("Spazio Libero rimasto: {} GB".format(round(free_space, 2)))
+            lines.append("Spazio Occupato: {} GB".format(round(used_space, 2)))
+        return "\n".join(lines) + "\n"
+
+
+def plan_transfers(free_gb=None):
+    """ Calcola senza spostare nulla quali archivi entrano sui dischi restando sopra la soglia e in che ordine.
+        Se free_gb non è indicato viene usato lo spazio libero dei dischi già montati. Ritorna il codice di uscita """
+    configuration = Configurator(CONF_PATH)
+    mount_point = configuration.get_path()
+    if free_gb is not None:
+        ledgers = {"--free": SpaceLedger.from_configuration(configuration, None, free=int(free_gb * 1024 * 1024 * 1024))}
+    elif configuration.is_enabled("disk", "multi"):
+        mount_points = [os.path.join(mount_point, uuid) for uuid in configuration.get_as_list("disk", "uuid")]
+        ledgers = {path: SpaceLedger.from_configuration(configuration, path)
+                   for path in mount_points if os.path.ismount(path)}
+    elif os.path.ismount(mount_point):
+        ledgers = {mount_point: SpaceLedger.from_configuration(configuration, mount_point)}
+    else:
+        ledgers = {}
+    if not ledgers:
+        print("Nessun disco montato in '{}': indicare lo spazio disponibile con --free".format(mount_point))
+        return 1
+    index = ScanIndex.from_configuration(configuration)
+    scheduler = TransferScheduler(BackupMover.find_servers(SOURCE_DIR, index), index)
+    for path, ledger in ledgers.items():
+        print("Spazio disponibile in '{}': {} GB - soglia: {} GB".format(
+            path, ledger.free_gb(), configuration.get("disk", "threshold")
+        ))
+    print()
+    planned, skipped, planned_size = 0, 0, 0
+    while True:
+        next_file = scheduler.next_file()
+        if next_file is None:
+            break
+        srv, source, metadata = next_file
+        name = "{}/{}".format(os.path.basename(os.path.normpath(srv)), BackupMover.get_new_name(source, metadata))
+        # senza misure di velocità i file vanno sul disco con più spazio libero
+        for path, ledger in sorted(ledgers.items(), key=lambda item: -item[1].free_gb()):
+            if ledger.reserve(metadata.st_size):
+                ledger.commit(metadata.st_size, metadata.st_size)
+                planned += 1
+                planned_size += metadata.st_size
+                print("{:>5}  {:<60} {:>10} GB  {}".format(
+                    planned, name, bytes_to_gb(metadata.st_size), path if len(ledgers) > 1 else ""
+                ))
+                break
+        else:
+            skipped += 1
+            print("  ---  {:<60} {:>10} GB  non entra".format(name, bytes_to_gb(metadata.st_size)))
+    print("\nArchivi copiabili: {} ( {} GB ) - spazio libero finale: {} GB".format(
+        planned, bytes_to_gb(planned_size), sum(ledger.free_gb() for ledger in ledgers.values())
+    ))
+    if skipped:
+        print("Archivi che non entrano sopra la soglia: {}".format(skipped))
+    print("Le dimensioni sono quelle non compresse: con la compressione attiva lo spazio occupato sarà minore")
+    return 0
+
+
+def query_catalog(text=None, date=None, include_evicted=False):
+    """ Stampa gli archivi del catalogo il cui server o nome contiene 'text', eventualmente solo quelli con
+        data 'date' ( AAAA-MM-GG ). Ritorna il codice di uscita """
+    catalog = Catalog.from_configuration(Configurator(CONF_PATH))
+    if catalog is None:
+        print("Catalogo disabilitato in [catalog] path")
+        return 1
+    rows = catalog.find(text, date, include_evicted)
+    catalog.close()
+    for uuid, server, original, path, archive_date, size, stored, checksum, copied, evicted in rows:
+        print("{:<38} {:<60} {:>10} GB  {}  {}{}".format(
+            uuid or "-", path, bytes_to_gb(size), archive_date or "-", original,
+            "  ( eliminato il {} )".format(evicted) if evicted else ""
+        ))
+    print("\nArchivi trovati: {}".format(len(rows)))
+    return 0 if rows else 1
+
+
+def catalog_usage():
+    """ Stampa per ogni disco numero di archivi e spazio occupato secondo il catalogo. Ritorna il codice di uscita """
+    catalog = Catalog.from_configuration(Configurator(CONF_PATH))
+    if catalog is None:
+        print("Catalogo disabilitato in [catalog] path")
+        return 1
+    rows = catalog.usage()
+    catalog.close()
+    print("{:<38} {:>8} {:>14} {:>14}  {}".format("Disco", "Archivi", "Originali GB", "Occupati GB", "Ultima copia"))
+    for uuid, count, size, stored, copied in rows:
+        print("{:<38} {:>8} {:>14} {:>14}  {}".format(
+            uuid or "-", count, bytes_to_gb(size or 0), bytes_to_gb(stored or 0), copied
+        ))
+    return 0
+
+
+def restore_archive(archive, output=None):
+    """ Ricostruisce dal deposito deduplicato l' archivio indicato ( '<mount>/<server>/<nome>_gg_mm_aaaa.gz' oppure
+        la sua ricetta ) in output, di default con lo stesso nome nella cartella corrente. Ritorna il codice di uscita """
+    recipe = ChunkStore.recipe_path(os.path.abspath(archive))
+    if not os.path.isfile(recipe):
+        print("Ricetta '{}' non trovata".format(recipe))
+        return 1
+    # il deposito è nella radice del disco, le ricette in '<radice>/<server>/'
+    mount_point = os.path.dirname(os.path.dirname(recipe))
+    if not os.path.isdir(os.path.join(mount_point, ChunkStore.DIRECTORY)):
+        print("Deposito deduplicato non trovato in '{}'".format(mount_point))
+        return 1
+    output = output or os.path.basename(recipe[:-len(ChunkStore.RECIPE_SUFFIX)])
+    store = ChunkStore(mount_point)
+    try:
+        written = store.restore(recipe, output)
+    except OSError as error:
+        print("Ricostruzione non riuscita: {}".format(error))
+        return 1
+    finally:
+        store.close()
+    print("Ricostruito '{}' ( {} GB )".format(output, bytes_to_gb(written)))
+    return 0
+
+
+def run_backup(configuration, log_path):
+    """ Esegue montaggio dei dischi, copia dei backup, smontaggio e invio dell' email di esito.
+        Ritorna l' esito ( 'successo', 'attenzione', 'errore' ) oppure None se un' altra copia è già in corso """
+    log = logging.getLogger()
+    # evito due copie contemporanee ( es. demone e cron )
+    os.makedirs(LOG_DIR, exist_ok=True)
+    with open(os.path.join(LOG_DIR, "mover.lock"), "w") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            log.warning("Un' altra copia è già in corso, esecuzione saltata")
+            return None
+        log.info("=======  COPIA BACKUP STORICO SU DISCO ESTERNO  =======  \n")
+        metrics = RunMetrics()
+        # monto i dischi: se almeno uno è montato posso iniziare il processo di copia
+        with metrics.stage("mount"):
+            mounters = mount_targets(configuration)
+
+        # Mount non eseguito
+        if not mounters:
+            log.error("La copia dei backup storici non è stata eseguita")
+            metrics.write(configuration, "errore")
+            send_mail(
+                subject="[ERRORE] Backup Storico",
+                content="La copia dei backup storici non è stata eseguita, vedi log per maggiori informazioni",
+                attach_name=log_path
+            )
+            return "errore"
+
+        # qualunque errore durante la copia non deve lasciare i dischi montati né i depositi aperti
+        mover = None
+        try:
+            with metrics.stage("scan"):
+                mover = BackupMover([(mounter.uuid, mounter.mount_point) for mounter in mounters], metrics)
+            # applico le politiche di conservazione, poi controllo lo spazio libero sul disco
+            with metrics.stage("retention"):
+                mover.apply_retention()
+            space_check = mover.check_threshold()
+            if space_check:
+                # lo scheduler legge una sola volta le cartelle month e restituisce i file dal più vecchio
+                workers = 1
+                if configuration.exists("transfer", "workers"):
+                    workers = max(1, int(configuration.get("transfer", "workers")))
+                if configuration.is_enabled("transfer", "pipeline"):
+                    # lettura delle cartelle e copie sovrapposte: la scansione fa parte della fase di copia
+                    with metrics.stage("copy"):
+                        mover.move_pipeline(workers)
+                else:
+                    with metrics.stage("scan"):
+                        scheduler = TransferScheduler(mover.srv_path_all, mover.index)
+                    with metrics.stage("copy"):
+                        mover.move_all(scheduler, workers)
+            report = mover.space_report()
+        finally:
+            try:
+                if mover is not None:
+                    mover.close()
+            finally:
+                with metrics.stage("unmount"):
+                    for mounter in mounters:
+                        mounter.unmount()  # smonto disco
 
-            # Secondo Loop stop - Nessun file rimasto
+        if mover.failed:
+            log.error("La copia di %s file non è riuscita", mover.failed)
+            metrics.write(configuration, "errore")
+            send_mail(
+                subject="[ERRORE] Backup Storico",
+                content="La copia di {} file non è riuscita: i file sono rimasti nelle cartelle 'month'!\n"
+                        "{}"
+                        "Leggere il log per maggiori informazioni".format(mover.failed, report),
+                attach_name=log_path
+            )
+            return "errore"
+
+        if space_check and mover.skipped == 0:
             log.info(
                 "Tutte le cartelle 'month' sono vuote"
             )
-            _, used_space, free_space = disk_usage_gb(configuration.get("disk", "mount_point"))
-            mounter.unmount()
+            metrics.write(configuration, "successo")
             send_mail(
                 subject="[SUCCESSO] Backup Storico",
                 content="Copia backup storici su disco esterno avvenuta con successo!\n"
-                        "Spazio Libero rimasto: {} GB\n"
-                        "Spazio Occupato: {} GB\n"
-                        "Leggere il log per maggiori informazioni".format(
-                         round(free_space, 2), round(used_space, 2),
-                        ),
+                        "{}"
+                        "Leggere il log per maggiori informazioni".format(report),
                 attach_name=log_path
             )
-            sys.exit()
+            return "successo"
 
-        # Primo loop stop - spazio al di sotto del livello critico
-        _, used, free = disk_usage_gb(configuration.get("disk", "mount_point"))
-        mounter.unmount()  # smonto disco
+        # spazio al di sotto del livello critico
+        metrics.write(configuration, "attenzione")
         send_mail(
             subject="[ATTENZIONE] Backup Storico",
             content="Lo spazio disponibile sul disco è al di sotto del livello critico!\n"
-                    "Spazio Libero rimasto: {} GB\n"
-                    "Spazio Occupato: {} GB\n"
-                    "Leggere il log per maggiori informazioni".format(
-                     round(free, 2), round(used, 2),
-                    ),
+                    "{}"
+                    "Leggere il log per maggiori informazioni".format(report),
             attach_name=log_path
         )
+        return "attenzione"
+
 
-    # Mount non eseguito
+def watch_disks(configuration, log_path):
+    """ Modalità demone: controlla ogni [daemon] interval secondi /dev/disk/by-uuid e appena viene collegato
+        uno dei dischi configurati esegue subito la copia, poi smonta e torna in attesa.
+        Un disco che resta collegato non fa ripartire la copia finché non viene scollegato e ricollegato """
+    log = logging.getLogger()
+    interval = 10
+    if configuration.exists("daemon", "interval"):
+        interval = float(configuration.get("daemon", "interval"))
+    uuids = set(configuration.get_as_list("disk", "uuid"))
+    log.info("Modalità demone: attendo il collegamento di uno dei dischi %s", ", ".join(sorted(uuids)))
+    handled = set()  # dischi collegati per cui la copia è già stata eseguita
+    first_run = True
+    while True:
+        attached = uuids & DeviceResolver.attached_uuids()
+        arrived = attached - handled
+        if arrived:
+            log.info("Rilevato collegamento del disco %s", ", ".join(sorted(arrived)))
+            if not first_run:
+                # ogni esecuzione ha il suo file di log da allegare all' email
+                rotate_log()
+            first_run = False
+            try:
+                run_backup(configuration, log_path)
+            except SystemExit:
+                log.error("Copia interrotta, torno in attesa")
+            except Exception:
+                log.exception("Errore imprevisto durante la copia, torno in attesa")
+            log.info("In attesa del prossimo disco")
+        handled = attached
+        time.sleep(interval)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Copia i backup storici su disco esterno")
+    parser.add_argument("--plan", action="store_true",
+                        help="mostra quali archivi verrebbero copiati e in che ordine, senza spostare nulla")
+    parser.add_argument("--free", type=float, metavar="GB",
+                        help="con --plan: spazio libero del disco da usare invece di quello del disco montato")
+    parser.add_argument("--daemon", action="store_true",
+                        help="resta in esecuzione e avvia la copia appena viene collegato uno dei dischi")
+    parser.add_argument("--find", metavar="TESTO", nargs="?", const="",
+                        help="cerca nel catalogo gli archivi il cui server o nome contiene TESTO, senza montare i dischi")
+    parser.add_argument("--date", metavar="AAAA-MM-GG", help="con --find: solo gli archivi con questa data")
+    parser.add_argument("--all", action="store_true", help="con --find: include gli archivi eliminati dai dischi")
+    parser.add_argument("--usage", action="store_true", help="mostra lo spazio occupato su ogni disco secondo il catalogo")
+    parser.add_argument("--restore", metavar="ARCHIVIO",
+                        help="ricostruisce dal deposito deduplicato l' archivio indicato ( es. /mnt/srv/img_01_02_2024.gz )")
+    parser.add_argument("--output", metavar="PATH",
+                        help="con --restore: file in cui ricostruire l' archivio ( default nella cartella corrente )")
+    args = parser.parse_args()
+    if args.plan:
+        sys.exit(plan_transfers(args.free))
+    if args.find is not None:
+        sys.exit(query_catalog(args.find, args.date, args.all))
+    if args.usage:
+        sys.exit(catalog_usage())
+    if args.restore:
+        sys.exit(restore_archive(args.restore, args.output))
+
+    # creo logger
+    log = logger()
+    # # Istanzio Configuratore
+    configuration = Configurator(CONF_PATH)
+    # # genero path di log
+    log_path = os.path.join(LOG_DIR, configuration.get("log", "name"))
+    if args.daemon:
+        watch_disks(configuration, log_path)
     else:
-        log.error("La copia dei backup storici non è stata eseguita")
-        send_mail(
-            subject="[ERRORE] Backup Storico",
-            content="La copia dei backup storici non è stata eseguita, vedi log per maggiori informazioni",
-            attach_name=log_path
-        )
+        run_backup(configuration, log_path)